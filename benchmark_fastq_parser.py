@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+
+# Copyright (C) 2016  Shengwei Hou : housw2010 'at' gmail 'dot' com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import argparse
+import tempfile
+from itertools import count, imap, izip
+from collections import deque
+from operator import attrgetter
+from utils.Fastq import Fastq, open_fastq, parse_fastq, FASTQ_BLOCK_SIZE
+
+
+def parse_fastq_readline(fastq_file):
+    """ the line by line parser parse_fastq() used before, for reference
+    :param fastq_file: input fastq file
+    :return:           yield Fastq record as a generator
+    """
+    ih = open_fastq(fastq_file)
+    header = ih.readline()
+    while header:
+        header = header.strip()[1:]
+        seq = ih.readline().strip()
+        ih.readline()
+        qual = ih.readline().strip()
+        yield Fastq(header, seq, qual)
+        header = ih.readline()
+    ih.close()
+
+
+def count_records(records, field=None):
+    """ iterate over records, optionally touching one field of each, records
+        are counted in C, a python loop costs about as much as a light record
+    :return: number of records
+    """
+    if field is not None:
+        records = imap(attrgetter(field), records)
+    counter = count()
+    deque(izip(records, counter), maxlen=0)
+    return next(counter)
+
+
+def check_parsers(sample="@r1 a\nACGT\n+\nIIII\n@r2/1\nGG\n+r2/1\n##\n"):
+    """ check that all parsers give the same fields for a small sample, with
+        LF and CRLF line ends, and a last record without newline
+    :return: None, AssertionError is raised if they differ
+    """
+    for text in (sample, sample.replace("\n", "\r\n"), sample.rstrip("\n")):
+        fd, path = tempfile.mkstemp(suffix=".fastq")
+        try:
+            os.write(fd, text)
+            os.close(fd)
+            expected = [(r.header, r.seq, r.qual) for r in parse_fastq_readline(path)]
+            for eager in (True, False):
+                fields = [(r.header, r.seq, r.qual) for r in parse_fastq(path, eager=eager, block_size=8)]
+                assert fields == expected, "parse_fastq(eager=%s) gives %r for %r, not %r"%(
+                    eager, fields, text, expected)
+        finally:
+            os.remove(path)
+
+
+def main():
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description="compare records/sec of fastq parsers")
+    parser.add_argument("fastq", help="input fastq file, uncompressed for parser speed alone")
+    parser.add_argument("-r", "--repeats", required=False, type=int, default=3,
+                        help="runs of each parser, the fastest one is reported")
+    parser.add_argument("-b", "--block_size", required=False, type=int, default=FASTQ_BLOCK_SIZE,
+                        help="block size of the block parser")
+    args = parser.parse_args()
+    check_parsers()
+
+    parsers = [("readline, Fastq", lambda: count_records(parse_fastq_readline(args.fastq))),
+               ("block, Fastq", lambda: count_records(parse_fastq(args.fastq, block_size=args.block_size))),
+               ("block, FastqRecord", lambda: count_records(parse_fastq(args.fastq, eager=False,
+                                                                        block_size=args.block_size))),
+               ("block, FastqRecord.header", lambda: count_records(parse_fastq(args.fastq, eager=False,
+                                                                               block_size=args.block_size),
+                                                                   "header"))]
+    baseline = None
+    print "parser\trecords\tseconds\trecords/sec\tspeedup"
+    for name, run in parsers:
+        best = None
+        for _ in range(args.repeats):
+            start = time.time()
+            n = run()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rate = n/best if best else 0.0
+        if baseline is None:
+            baseline = rate
+        print "%s\t%d\t%.3f\t%.0f\t%.1fx"%(name, n, best, rate, rate/baseline if baseline else 0.0)
+
+
+if __name__ == "__main__":
+    main()
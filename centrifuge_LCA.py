@@ -1,697 +1,591 @@
 #!/usr/bin/python
 
-import subprocess
+import argparse
+import os
+import json
+import time
+import multiprocessing
 from collections import OrderedDict
-import sys, os, math
-import Bio.Phylo as bp
-from Bio.Phylo import Newick
+import numpy as np
+from utils.Centrifuge import CentrifugeRecordParser, split_read_groups, load_centrifuge_columns, \
+    partition_read_groups
+from utils.Taxonomy import TaxIds, shared_snapshot_path
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 
 
+# hits below this score are not used
+MIN_SCORE = 100
 
-#-----------------------------------------------------------#
-#           Classes used to parse centrifuge records        #
-#-----------------------------------------------------------#
+# hits scoring below this fraction of the best hit of a sequence are not used
+CUTOFF_FRACTION = 0.98
 
+# input is split into chunks of about this size for parallel workers
+PARALLEL_CHUNK_BYTES = 32 << 20
 
-class CentrifugeRecord(object):
-    """ This class used to represent centrifuge records in tabular result
+# checkpoints are written this often, in seconds, if --resume is given without --checkpoint
+CHECKPOINT_INTERVAL = 300
 
-        0      1       2     3         4           5        6
-    readID uniqueID  taxID score secBestScore hitLength numMatches
-
-    """
-    __slots__=["readID", "uniqueID", "taxID", "score", "secBestScore",
-               "hitLength", "numMatches"]
-
-    record_dict = {} # {readID:CentrifugeRecord}
-
-    def __init__(self, readID, uniqueID, taxID, score, secBestScore, hitLength, numMatches):
-        self.readID = readID
-        self.uniqueID = uniqueID
-        self.taxID = taxID
-        self.score = score
-        self.secBestScore = secBestScore
-        self.hitLength = hitLength
-        self.numMatches = numMatches
-
-        if not self.readID in CentrifugeRecord.record_dict:
-            CentrifugeRecord.record_dict[self.readID] = [self]
-        else:
-            CentrifugeRecord.record_dict[self.readID].append(self)
-
-    def __str__(self):
-        return self.readID +"\t"+self.uniqueID+"\t"+\
-               str(self.taxID)+"\t"+str(self.score)+"\t"+str(self.secBestScore)+\
-               "\t"+str(self.hitLength)+"\t"+str(self.numMatches)
-
-
-
-
-class CentrifugeRecordParser(object):
-    """ This class used to parse centrifuge results iteratorly
-    """
-    def __init__(self, fh):
-        """This parser is used to parse centrifuge result
-        """
-        self.handle = fh
-
-    def _yield_records(self):
-        """ This function used to yield mblastx record one by one
-        """
-        _file_handle = None
-        # a opened file
-        if hasattr(self.handle, 'read'):
-            _file_handle = self.handle
-        else:
-            try:
-                _file_handle = open(self.handle, "r")
-            except Exception as e:
-                print "cann't open file for read: %s !"%e
-
-        for i, line in enumerate(_file_handle):
-            if line.startswith("readID") or \
-               line.startswith("\n") or \
-               line.startswith(" ") or \
-               line.startswith("\t"):
-                continue
-            line = line.strip().split("\t")
-            #assert len(line) == 7, "The lenght of %d-th line is not 7 !!!"
-            if len(line) != 7:
-                print "Warning: the fields number of line %d is not 7, will be passed!!"%i
-                print line
-                continue
-            yield CentrifugeRecord(*line)
-    def __iter__(self):
-        return self._yield_records()
-
-
-
-
-
-
-
-
-
-
-
-#--------------------------------------------------------------#
-#             BlastRecord and RecordParser                     #
-#--------------------------------------------------------------#
-
-
-class BlastRecord(object):
-    """ This class used to represent tabular blast record in *.tab file, fields are
-
-        0     1     2      3         4      5     6     7      8      9      10     11
-    QID RefID Ident AlignLen MisMatch Gaps QStart QEnd RefStart RefEnd Evalue BitScore
-
-    """
-
-    __slots__=["QID", "RefID", "Ident", "AlignLen", "MisMatch", "Gaps",
-               "QStart", "QEnd", "RefStart", "RefEnd", "Evalue", "BitScore"]
-
-
-
-    def __init__(self,
-                 QID=None, RefID=None,
-                 Ident=None, AlignLen=None,
-                 MisMatch=None, Gaps=None,
-                 QStart=None, QEnd=None,
-                 RefStart=None, RefEnd=None,
-                 Evalue=None, BitScore=None
-                 ):
-        self.QID=QID
-        self.RefID=RefID
-        self.Ident=Ident
-        self.AlignLen=AlignLen
-        self.MisMatch=MisMatch
-        self.Gaps=Gaps
-        self.QStart=QStart
-        self.QEnd=QEnd
-        self.RefStart=RefStart
-        self.RefEnd=RefEnd
-        self.Evalue=Evalue
-        self.BitScore=BitScore
-
-    def __str__(self):
-        """ string representation of blast record, the same with initial blast
-            tabular output
-        """
-        _str=""
-        _str += self.QID+"\t"
-        _str += self.RefID+"\t"
-        _str += self.Ident+"\t"
-        _str += str(self.AlignLen)+"\t"
-        _str += str(self.MisMatch)+"\t"
-        _str += str(self.Gaps)+"\t"
-        _str += str(self.QStart)+"\t"
-        _str += str(self.QEnd)+"\t"
-        _str += str(self.RefStart)+"\t"
-        _str += str(self.RefEnd)+"\t"
-        _str += str(self.Evalue)+"\t"
-        _str += str(self.BitScore)
-        return _str
-
-class BlastRecordParser(object):
-    """ This class used to parse tabular blast record in *.tab file, yield
-        BlastRecord instance one by one
-    """
-
-    def __init__(self, fh):
-        self.handle = fh
-
-
-    def _yield_records(self):
-        """ This function used to yield tabular blast records
-        """
-        _file_handle = None
-        if not hasattr(self.handle, "read"):
-            try:
-                _file_handle = open(self.handle, "r")
-            except Exception as e:
-                print e
-                print "can not open file for read !"
-        else:
-            _file_handle = self.handle
-
-        for i, line in enumerate(_file_handle):
-            if line.startswith("\n") or line.startswith("#"):
-                continue
-            line = line.strip().split("\t")
-            assert len(line) == 12, "Bad blast record was found in %d-th line"%i+1
-            yield BlastRecord(*line)
-
-    def __iter__(self):
-        return self._yield_records()
+# names.dmp and nodes.dmp used if neither they nor a snapshot or taxdmp.zip are given
+DEFAULT_NAMES = "/data/shengwei/Alteromonas_meta/centrifuge/taxdmp/names.dmp"
+DEFAULT_NODES = "/data/shengwei/Alteromonas_meta/centrifuge/taxdmp/nodes.dmp"
 
+# read-only state shared with forked workers, see process_chunk()
+_worker_state = {}
 
+HEADER = "#ContigID\tLCA_TaxID\tLCA_SciName\tLCA_Rank\tLCA_Path\tMaxScore\tSuperkingdom\tphylum\tclass\torder\tfamily\tgenus\n"
 
 
-
-#-------------------------------------------------------------#
-#    class of NCBI taxid, use to find lca, newick tree ...    #
-#-------------------------------------------------------------#
-
-
-class TaxIds(object):
-    """ This class used to store taxid, sciName, parentTaxid and rank
-        info, a path2file need as input to initialize. lines in path2file
-        looks like below:
-
-        taxid    scientificName    parentTaxid    rank\n
+class LRUCache(object):
+    """ bounded least recently used cache, counts hits and misses of get()
     """
 
-    _taxdmp_ftp = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdmp.zip"
-
-    def __init__(self, names=None, nodes=None):
-        self.names = names
-        self.nodes = nodes
-        self.container = self._update_taxid_dict()
-
-
-    def _update_taxid_dict(self, dir=os.getcwd()):
-        """
-        :param dir: tmp directory to put downloaded taxdmp.zip, and unzipped folder
-        :return: taxid_dict
-        """
-        _taxid_dict = {} # {taxid: [scientificName, parent, rank]}
-
-        # open names and nodes file for read, if given
-        if self.names and self.nodes:
-            try:
-                names = open(self.names, "r")
-                nodes = open(self.nodes, "r")
-            except Exception as e:
-                print "Cannot open names or nodes file for read: %s"%e
-
-        # download taxdmp file, unzip, then open names and nodes file for read
-        else:
-
-            if os.path.exists(os.path.join(dir, "taxdmp.zip")):
-                print "\n\nWARNING: taxdmp.zip exists, will be removed!\n\n"
-                os.system("rm %s"%os.path.join(dir, "taxdmp.zip"))
-
-            # download
-            try:
-                proc = subprocess.Popen(["wget",
-                                               self._taxdmp_ftp, # ftp address for taxdmp
-                                               "-P", dir    # directory to save taxdmp
-                                             ])
-                proc.wait()
-            except Exception as e:
-                print "Cannot download taxdmp file because: %s"%e
-            # unzip
-            try:
-                proc = subprocess.Popen(["unzip",
-                                         "-o",                              # overwrite files without prompting
-                                         "-d", os.path.join(dir, "taxdmp"),  # extract files into directory
-                                         os.path.join(dir, "taxdmp.zip")])
-                proc.wait()
-            except Exception as e:
-                print "Error raised in unzipping taxdmp.zip file: %s"%e
-            # read
-            try:
-                names = open(os.path.join(dir, "taxdmp", "names.dmp"), "r")
-                nodes = open(os.path.join(dir, "taxdmp", "nodes.dmp"), "r")
-            except Exception as e:
-                print "Cannot open names or nodes file for read: %s"%e
-
-        # read names.dmp,
-        for line in names:
-            if line.startswith("\n"):
-                continue
-            line = line.rstrip("\t|\n").split("\t|\t")
-            if line[3] == "scientific name":
-                # first get taxid:[scitificname]
-                _taxid_dict.update({int(line[0]):[line[1]]})
-
-        for line in nodes:
-            if line.startswith("\n"):
-                continue
-            line = line.rstrip("\t|\n").split("\t|\t")
-            taxid = int(line[0])
-            parent = int(line[1])
-            rank = line[2]
-            if taxid in _taxid_dict:
-                _taxid_dict[taxid].append(parent)
-                _taxid_dict[taxid].append(rank)
-            else:
-                _taxid_dict.update({taxid:["None", parent, rank]})
-
-        if not names.closed:
-            names.close()
-        if not nodes.closed:
-            nodes.close()
-
-        return _taxid_dict
-
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.worker_entries = {} # {worker pid: entries used}, of copies in worker processes
+        self._data = OrderedDict()
 
-    def get_parent(self, taxid):
-        """ given a taxid, return its parent's taxid
-        :param taxid: input query taxid
-        :return:      the parent taxid of input query taxid
+    def get(self, key):
+        """ return cached value of key and mark it as recently used, None if
+            key is not cached
         """
-        if not taxid:
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
             return None
+        self._data[key] = value
+        self.hits += 1
+        return value
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
-
-        if self.container.has_key(taxid):
-            return self.container[taxid][1]
-
-    def get_sciName(self, taxid):
-        """ given a taxid, return its scientific name
-        :param taxid: input query taxid
-        :return:      scientific name of input query taxid
-        """
-        if taxid is None:
-            return None
-
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
-
-        if self.container.has_key(taxid):
-            return self.container[taxid][0]
-
-    def get_rank(self, taxid):
-        """ given a taxid, return its rank info
-        :param taxid:  input query taxid
-        :return:       the taxonomy rank of input query taxid
+    def put(self, key, value):
+        """ cache value of key, drop the least recently used one if full
         """
-        if not taxid:
-            return None
+        if self.max_size <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
-
-        if self.container.has_key(taxid):
-            return self.container[taxid][2]
+    def __len__(self):
+        return len(self._data)
 
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ret = "LCA cache: %d hits, %d misses, %.2f%% hit rate, "%(
+              self.hits, self.misses, 100.0*self.hits/lookups if lookups else 0.0)
+        if self.worker_entries:
+            return ret + "%d entries used by %d workers, at most %d of %d in one"%(
+                   sum(self.worker_entries.values()), len(self.worker_entries),
+                   max(self.worker_entries.values()), self.max_size)
+        return ret + "%d of %d entries used"%(len(self._data), self.max_size)
+
+
+class Checkpoint(object):
+    """ how far a run got, kept in a small json file next to output: the byte
+        offset of input at a read group boundary, the size of output flushed
+        to disk for all reads before it, and the LCA counts of these reads
+    """
 
-    def get_path(self, taxid, toStr=False):
-        """ given a taxid, return its path from root to this node
-        :param taxid:  input query taxid
-        :param toStr:  if True, return path in ";" separated string format, else in list format
-        :return:       the taxonomic path from root to current taxid
+    def __init__(self, path, input_file, interval=CHECKPOINT_INTERVAL):
         """
-        if not taxid:
-            return None
-
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
-
-        _path = []
-        _path.append(taxid)
-        while taxid:
-            taxid = self.get_parent(taxid)
-            if taxid:
-                _path.append(taxid)
-
-            if taxid == 1:
-                break
-        # reverse list, making it from root to leaves
-        _path.reverse()
-
-        if toStr:
-            _str = [self.get_sciName(taxid) for taxid in _path]
-            return ";".join(_str)+";"
-        else:
-            return _path
-
-    def get_query_rank_from_path(self, Taxid_Path, query_rank, toStr=False):
+        :param path:       checkpoint file
+        :param input_file: centrifuge result file of this run
+        :param interval:   seconds between two checkpoints, 0 for every chunk
         """
-        :param Taxid_Path: the path of taxid from root to leaves
-        :param query_rank: the rank level want to query
-        :param toStr:      if true, return scientific name, else return taxid
-        :return:           the queried rank in scientific name or taxid
+        self.path = path
+        self.input_file = input_file
+        self.interval = interval
+        self._last = time.time()
+
+    def _input_stamp(self):
+        st = os.stat(self.input_file)
+        return [st.st_size, int(st.st_mtime)]
+
+    def load(self):
+        """ read the last checkpoint
+        :return: (input offset, output size, {lca taxid: number of sequences}),
+                 None if there is no checkpoint
         """
-
-        # assume only one meet the query_rank in one Taxid_Path
-        ret = False
-        for taxid in Taxid_Path:
-            if not type(taxid) == int:
-                try:
-                    taxid = int(str(taxid).strip())
-                except Exception as e:
-                    print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
-            _rank = self.get_rank(taxid)
-            if _rank == query_rank:
-                ret = True
-                if toStr:
-                    return self.get_sciName(taxid)
-                else:
-                    return taxid
-        # if no query_rank found in taxid_path, then return None
-        if not ret:
+        if not os.path.exists(self.path):
             return None
-
-
-    def _get_first_common_ancestor(self, taxid1, taxid2=None):
-        """ this function take two taxid nodes as input, find their first
-            common ancestor. This function should be used inside self.get_lca(),
-            and should not be called outside.
-        :param taxid1:  input first query taxid
-        :param taxid2:  input second query taxid
-        :return:        the common ancestor of these two taxid
-        """
-        # if two taxids are given, compare their pathes to find common_ancestor
-        if taxid2:
-            _path1 = self.get_path(taxid1)
-            _path2 = self.get_path(taxid2)
-
-            # find shorter path and longer path
-            shorter, longer = (_path1, _path2) if len(_path1) <= len(_path2) \
-                                else (_path2, _path1)
-
-            if len(shorter) == 0:
-                return longer.pop()
-
-            # iterate over shorter path to check whether item in longer path
-            common_ancestor = shorter.pop()
-            while common_ancestor not in longer:
-                try:
-                    common_ancestor = shorter.pop()
-                except IndexError:
-                    print "%s or %s is not tracing back to the root !!!"%(
-                            str(_path1), str(_path2))
-                    break
-            return common_ancestor
-
-        # if only one taxid is given, then the renturn the last node in its path
-        else:
-            _path1 = self.get_path(taxid1)
-            return _path1.pop()
-
-
-    def get_lca(self, ListOfTaxid):
-        """ given a list of taxid, return their lowest common ancestor
-        :param ListOfTaxid:
-        :return:
+        with open(self.path, "r") as ih:
+            state = json.load(ih)
+        if state["input"] != os.path.abspath(self.input_file) or state["stamp"] != self._input_stamp():
+            raise ValueError("Checkpoint %s was written for another or a changed input"%self.path)
+        lca_counts = dict((int(taxid), count) for taxid, count in state["lca_counts"].iteritems())
+        return state["input_offset"], state["output_size"], lca_counts
+
+    def save(self, oh, input_offset, lca_counts, force=False):
+        """ record that input up to input_offset is done, if interval passed
+        :param oh:           opened output file, it is flushed to disk first
+        :param input_offset: byte offset of input at a read group boundary
+        :param lca_counts:   {lca taxid: number of sequences} up to input_offset
+        :param force:        if True, write it regardless of interval
+        :return:             None
         """
-        if len(ListOfTaxid) > 1:
-            ListOfTaxid = [int(item) for item in ListOfTaxid]
-            return reduce(self._get_first_common_ancestor, ListOfTaxid)
-
-        elif len(ListOfTaxid) == 1:
-            return self._get_first_common_ancestor(ListOfTaxid[0])
-
-        else:
-            print "\n\n No Taxid was given in ListOfTaxid !!\n\n"
-            sys.exit(0)
-
-    def path2newick(self, path2pathFile, node_fmt="taxid", out_fmt="newick"):
-        """ This function take taxonomic path file as input, path should be consist
-            of taxonomic id, not scitific name, because some scientific name are the
-            same in different rank, but ids are unique.
-
-            node_fmt = taxid / sciName
-
-            out_fmt = newick / phyloxml ...
+        if not force and time.time() - self._last < self.interval:
+            return
+        oh.flush()
+        os.fsync(oh.fileno())
+        state = {"input": os.path.abspath(self.input_file),
+                 "stamp": self._input_stamp(),
+                 "input_offset": input_offset,
+                 "output_size": oh.tell(),
+                 "lca_counts": lca_counts}
+        # replace the old checkpoint only once the new one is complete
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as ch:
+            json.dump(state, ch)
+            ch.flush()
+            os.fsync(ch.fileno())
+        os.rename(tmp, self.path)
+        self._last = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CladeFilter(object):
+    """ keep hits under any of include clades, and not under any of exclude
+        clades, clades are given by taxid or by scientific name
+    """
 
+    def __init__(self, Tax_ID, include=None, exclude=None):
+        self.Tax_ID = Tax_ID
+        self.include = [self._resolve_clade(clade) for clade in include or []]
+        self.exclude = [self._resolve_clade(clade) for clade in exclude or []]
+
+    def _resolve_clade(self, clade):
+        if clade.isdigit():
+            return int(clade)
+        taxids = self.Tax_ID.get_taxids(clade, synonyms=False)
+        if not taxids:
+            raise ValueError("No taxid is found for clade %s"%clade)
+        if len(taxids) > 1:
+            raise ValueError("Clade %s is ambiguous, use one of taxids %s instead"%(
+                             clade, ", ".join(str(taxid) for taxid in taxids)))
+        return taxids[0]
+
+    def keep_taxid(self, taxid):
+        """ check one hit taxid
         """
-        path, fileName = os.path.split(path2pathFile)
-        basename = os.path.splitext(fileName)[0]
-        outFile = os.path.join(path, basename+"2tree_"+node_fmt+"."+out_fmt)
-
-
-        with open(path2pathFile, "r") as pathFile:
-
-            # read in pathFile, and store node info into nodes
-            nodes = {} # data format {"node_name": Clade_object}
-            root = None
-
-            # open file to parese line iterately
-            for i, line in enumerate(pathFile):
-                line = line.strip()
-                if line.endswith(";"):
-                    line = line.rstrip(";")
-                line = line.strip().split(";")
-                if root is None:
-                    root = line[1]
-                else:
-                    assert root == line[1], "The %d-th line is from a different root"%(i+1)
-
-                # check node iterately, first reverse list, to from leaf to root
-                # to make sure every node has a parent node
-                leaf2root = line[::-1]
-
-                for j, item in enumerate(leaf2root):
-                    # find child_node and parent_node, root node's parent is itself
-                    if j == len(line)-1:
-                        child_node = item; parent_node=item
-                    else:
-                        child_node = item; parent_node = leaf2root[j+1]
-
-                    if nodes.has_key(child_node):
-                        continue
-                    else:
-                        # add this node
-                        nodes[child_node] = Newick.Clade(name=child_node)
-                        # add its parent info
-                        nodes[child_node].parent = parent_node
-
-            for node_name, node_clade in nodes.iteritems():
-                # find the root node, its parent is itself
-                if node_name == node_clade.parent:
-                    root_node = node_clade
-                    print node_clade
-                    print "root node found!! "
-                # if node is not root, then find its parent, and add to its parent's clades
-                else:
-                    parent_node = nodes[node_clade.parent]
-                    parent_node.clades.append(node_clade)
-                del node_clade.parent
-
-            # transform between output node format
-            if node_fmt=="taxid":
-                tree = Newick.Tree(root = root_node)
-            else:
-                assert node_fmt =="sciName", "The node_fmt should be taxid or sciName"
-                # convert taxid to sciName
-                for node_name, node in nodes.iteritems():
-                    node_name = self.get_sciName(node_name)
-                    for child in node.clades:
-                        if child:
-                            child.name = self.get_sciName(child.name)
-                root_node.name = self.get_sciName(root_node.name)
-                tree = Newick.Tree(root = root_node)
+        if self.include and not any(self.Tax_ID.is_in_clade(taxid, clade) for clade in self.include):
+            return False
+        return not any(self.Tax_ID.is_in_clade(taxid, clade) for clade in self.exclude)
 
-            # write tree to file
-            print 'Writing %s tree to %s...' % (out_fmt, outFile)
-
-            bp.write(tree, outFile, out_fmt)
-
-
-    def taxid2tree(self, taxid_list, out_fmt="newick"):
-        """ This function take a list of gi as input, will generate a path for
-            for each gi, then construct a newick or phyloxml tree based on these
-            gi pathes.
-
-            out_fmt = newick / phyloxml ...
+    def keep(self, taxids):
+        """ check a numpy array of hit taxids
+        :return: numpy bool array, True for hits kept
         """
-        treeFile = StringIO()
-
-        # get pathes for a list of taxid
-        path_list =[";".join([str(item) for item in self.get_path(taxid)])
-                    for taxid in taxid_list ]
-
-        # read in pathFile, and store node info into nodes
-        nodes = {} # data format {"node_name": Clade_object}
-        root = None
-
-        # to parese path iterately
-        for i, path in enumerate(path_list):
-            line = path.strip().split(";")
-            if root is None:
-                root = line[0]
-            else:
-                assert root == line[0], "The %d-th line is from a different root"%(i+1)
-
-            # check node iterately, first reverse list, to from leaf to root
-            # to make sure every node has a parent node
-            leaf2root = line[::-1]
-
-            for j, item in enumerate(leaf2root):
-                # find child_node and parent_node, root node's parent is itself
-                if j == len(line)-1:
-                    child_node = item; parent_node=item
-                else:
-                    child_node = item; parent_node = leaf2root[j+1]
-
-                if nodes.has_key(child_node):
-                    continue
-                else:
-                    # add this node
-                    nodes[child_node] = Newick.Clade(name=child_node)
-                    # add its parent info
-                    nodes[child_node].parent = parent_node
-
-        for node_name, node_clade in nodes.iteritems():
-            # find the root node, its parent is itself
-            if node_name == node_clade.parent:
-                root_node = node_clade
-                print "root node is %s, constructing tree ..."%(str(node_name))
-            # if node is not root, then find its parent, and add to its parent's clades
-            else:
-                parent_node = nodes[node_clade.parent]
-                parent_node.clades.append(node_clade)
-            del node_clade.parent
-
-
-        tree = Newick.Tree(root = root_node)
-
-        bp.write(tree, treeFile, out_fmt)
-
-        treeStr = treeFile.getvalue()
-
-        return treeStr
+        return self.Tax_ID.filter_clades_batch(taxids, self.include, self.exclude)
 
 
+def is_valid_hit(rec):
+    """ hits without a taxID assigned or with a score below MIN_SCORE are not used
+    """
+    return int(rec.taxID) != 0 and int(rec.score) >= MIN_SCORE
 
 
+def filter_hits(hits):
+    """ given valid hits of one sequence, find the max score, set 0.98*max as
+        cutoff for LCA
+    :param hits: list of CentrifugeRecord of one sequence
+    :return:     (max_score, [taxid, ...]), None if no valid hit is given
+    """
+    hits = [hit for hit in hits if is_valid_hit(hit)]
+    if not hits:
+        return None
+
+    rec_scores = [int(hit.score) for hit in hits]
+    max_score = max(rec_scores)
+    cutoff_score = int(max_score * CUTOFF_FRACTION)
+    rec_taxIDs = [int(hit.taxID) for hit, score in zip(hits, rec_scores) if score >= cutoff_score]
+    return max_score, rec_taxIDs
+
+
+def iter_lca_batches_columnar(chunks, clade_filter=None):
+    """ same as iter_lca_batches(), but filter hits of each read group of
+        CentrifugeColumns chunks with array operations
+    :param chunks:       iterable of CentrifugeColumns
+    :param clade_filter: CladeFilter applied to hits before the score cutoff,
+                         or None
+    :return:             yield (contigs, max_scores, group_taxids, offsets)
+    """
+    for columns in chunks:
+        valid = (columns.taxID != 0) & (columns.score >= MIN_SCORE)
+        if clade_filter is not None:
+            valid[valid] = clade_filter.keep(columns.taxID[valid])
+        read_code = columns.read_code[valid]
+        if not len(read_code):
+            continue
+        score = columns.score[valid]
+        taxID = columns.taxID[valid]
+
+        # max score and cutoff of each read group
+        group_start = np.flatnonzero(np.append(True, read_code[1:] != read_code[:-1]))
+        max_scores = np.maximum.reduceat(score, group_start)
+        cutoff_scores = (max_scores * CUTOFF_FRACTION).astype(np.int64)
+        group_size = np.diff(np.append(group_start, len(read_code)))
+        keep = score >= np.repeat(cutoff_scores, group_size)
+
+        # the best hit always passes, so no read group becomes empty
+        group = np.repeat(np.arange(len(group_start)), group_size)[keep]
+        offsets = np.searchsorted(group, np.arange(len(group_start)+1))
+        yield (columns.readIDs[read_code[group_start]].tolist(), max_scores.tolist(),
+               taxID[keep].tolist(), offsets.tolist())
+
+
+def iter_lca_batches(read_groups):
+    """ collect filtered hits of many sequences into one batch for
+        TaxIds.get_lca_batch(), taxids of contigs[i] are
+        group_taxids[offsets[i]:offsets[i+1]]
+    :param read_groups: iterable of (contigID, [CentrifugeRecord, ...])
+    :return:            yield (contigs, max_scores, group_taxids, offsets)
+    """
+    contigs = []
+    max_scores = []
+    group_taxids = []
+    offsets = [0]
+    for contig, hits in read_groups:
+        filtered = filter_hits(hits)
+        if filtered is None:
+            continue
+        max_score, rec_taxIDs = filtered
+        contigs.append(contig)
+        max_scores.append(max_score)
+        group_taxids.extend(rec_taxIDs)
+        offsets.append(len(group_taxids))
+    if contigs:
+        yield contigs, max_scores, group_taxids, offsets
+
+
+def write_lca_batch(Tax_ID, oh, batch, cache=None):
+    """ resolve LCA and lineage of one batch, and write them out, sequences
+        hitting the same set of taxids share one result
+    :param Tax_ID: TaxIds instance
+    :param oh:     opened output file
+    :param batch:  (contigs, max_scores, group_taxids, offsets)
+    :param cache:  LRUCache of results keyed on sorted unique taxids, or None
+    :return:       numpy array of LCA taxid of each written sequence
+    """
+    contigs, max_scores, group_taxids, offsets = batch
+
+    # find results in cache, or collect the taxid sets still to resolve
+    keys = []
+    results = {} # {taxid set: (lca taxid, lca columns, lineage columns)}
+    todo = []    # [(taxid set, taxids)]
+    for i in range(len(contigs)):
+        taxids = group_taxids[offsets[i]:offsets[i+1]]
+        key = tuple(sorted(set(taxids)))
+        keys.append(key)
+        if key in results:
+            if cache is not None:
+                cache.hits += 1
+            continue
+        results[key] = cache.get(key) if cache is not None else None
+        if results[key] is None:
+            todo.append((key, taxids))
+
+    if todo:
+        todo_taxids = []
+        todo_offsets = [0]
+        for key, taxids in todo:
+            todo_taxids.extend(taxids)
+            todo_offsets.append(len(todo_taxids))
+
+        # LCA analysis of all contigs in one batch
+        lca_taxids, lca_ranks, _ = Tax_ID.get_lca_batch(np.array(todo_taxids, dtype=np.int64),
+                                                        np.array(todo_offsets, dtype=np.int64))
+        # superkingdom, phylum, class (or subclass), order, family and genus
+        lineage_columns = [Tax_ID.lineage_ranks.index(rank) for rank in
+                           ("superkingdom", "phylum", "class", "order", "family", "genus")]
+        lineages = Tax_ID.get_lineage_batch(lca_taxids)[:, lineage_columns]
+
+        for (key, _), lca_taxid, lca_rank, lineage in zip(todo, lca_taxids, lca_ranks, lineages):
+            lca_taxid = int(lca_taxid)
+            lca_scientificName = Tax_ID.get_sciName(lca_taxid)
+            lca_path = Tax_ID.get_path(lca_taxid, toStr=True)
+            lineage = [Tax_ID.get_sciName(int(taxid)) if taxid else "None" for taxid in lineage]
+            results[key] = (lca_taxid,
+                            str(lca_taxid)+"\t"+lca_scientificName+"\t"+lca_rank+"\t"+lca_path,
+                            "\t".join(lineage))
+            if cache is not None:
+                cache.put(key, results[key])
 
+    # write out lca assigned taxonomy for each contig
+    written = []
+    for contig, max_score, key in zip(contigs, max_scores, keys):
+        lca_taxid, lca_columns, lineage_columns = results[key]
+        oh.write(contig+"\t"+lca_columns+"\t"+str(max_score)+"\t"+lineage_columns+"\n")
+        written.append(lca_taxid)
+    return np.array(written, dtype=np.int64)
+
+
+def count_lca(lca_counts, lca_taxids):
+    """ add the number of sequences assigned to each LCA taxid to lca_counts
+    :param lca_counts: {lca taxid: number of sequences}
+    :param lca_taxids: numpy array of LCA taxid of sequences
+    :return:           None
+    """
+    taxids, counts = np.unique(lca_taxids, return_counts=True)
+    for taxid, count in zip(taxids.tolist(), counts.tolist()):
+        lca_counts[taxid] = lca_counts.get(taxid, 0) + count
+
+
+def process_chunk(byte_range):
+    """ LCA of the read groups in one byte range of input, run in worker
+        processes, the taxonomy is inherited from parent process when forked
+    :param byte_range: (start, end) from split_read_groups()
+    :return:           (output lines of this chunk, {lca taxid: number of
+                       sequences}, cache hits, cache misses, (worker pid,
+                       cache entries used))
+    """
+    oh = StringIO()
+    lca_counts = {}
+    cache = _worker_state["cache"]
+    hits, misses = cache.hits, cache.misses
+    chunks = load_centrifuge_columns(_worker_state["input"], byte_range=byte_range)
+    for batch in iter_lca_batches_columnar(chunks, _worker_state["clade_filter"]):
+        count_lca(lca_counts, write_lca_batch(_worker_state["Tax_ID"], oh, batch, cache))
+    return oh.getvalue(), lca_counts, cache.hits - hits, cache.misses - misses, (os.getpid(), len(cache))
+
+
+def run_parallel(Tax_ID, input_file, oh, threads, cache, lca_counts, clade_filter=None,
+                 start=0, checkpoint=None):
+    """ split input at read group boundaries, process chunks in a pool of
+        worker processes, write chunk outputs in input order
+    :param Tax_ID:     TaxIds instance, shared read-only with workers
+    :param input_file: centrifuge result file, grouped by readID
+    :param oh:         opened output file
+    :param threads:    number of worker processes
+    :param cache:      LRUCache, each worker gets its own copy, hits and
+                       misses of all workers are added to it, and the
+                       entries used in each worker are kept in it
+    :param lca_counts: {lca taxid: number of sequences}, counts of all
+                       workers are added to it
+    :param clade_filter: CladeFilter applied to hits, or None
+    :param start:      byte offset of input to start from, at a read group
+                       boundary, see Checkpoint
+    :param checkpoint: Checkpoint saved after chunks are written, or None
+    :return:           None
+    """
+    n_chunks = max(threads*4, os.path.getsize(input_file)//PARALLEL_CHUNK_BYTES)
+    chunks = [(max(chunk_start, start), chunk_end) for chunk_start, chunk_end in
+              split_read_groups(input_file, n_chunks) if chunk_end > start]
+
+    _worker_state["Tax_ID"] = Tax_ID
+    _worker_state["input"] = input_file
+    _worker_state["cache"] = cache
+    _worker_state["clade_filter"] = clade_filter
+    pool = multiprocessing.Pool(threads)
+    try:
+        for i, (text, chunk_counts, hits, misses, (pid, entries)) in enumerate(pool.imap(process_chunk, chunks)):
+            oh.write(text)
+            for taxid, count in chunk_counts.iteritems():
+                lca_counts[taxid] = lca_counts.get(taxid, 0) + count
+            cache.hits += hits
+            cache.misses += misses
+            cache.worker_entries[pid] = entries
+            if checkpoint is not None:
+                checkpoint.save(oh, chunks[i][1], lca_counts)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _worker_state.clear()
 
 
 def main():
 
-    if len(sys.argv) !=2:
-        print "\nUsage: python %s[input_centrifuge_output]\n"%sys.argv[0]
-        sys.exit(0)
+    # parse arguments
+    parser = argparse.ArgumentParser(description="assign the LCA taxonomy to each sequence in centrifuge output")
+    parser.add_argument("input_centrifuge_output", help="input centrifuge output in tabular format")
+    parser.add_argument("--names", required=False,
+                        help="names.dmp of NCBI taxonomy, %s if neither it nor --snapshot, --shared "
+                             "or --taxdmp is given"%DEFAULT_NAMES)
+    parser.add_argument("--nodes", required=False,
+                        help="nodes.dmp of NCBI taxonomy, %s if neither it nor --snapshot, --shared "
+                             "or --taxdmp is given"%DEFAULT_NODES)
+    parser.add_argument("--taxdmp", required=False,
+                        help="taxdmp.zip of NCBI taxonomy, names.dmp and nodes.dmp are read from it "
+                             "instead of --names and --nodes")
+    parser.add_argument("--download", required=False, action="store_true",
+                        help="download taxdmp.zip of NCBI taxonomy into the current directory to build "
+                             "--snapshot or --shared from, if neither --names and --nodes nor --taxdmp is given")
+    parser.add_argument("--lazy_names", required=False, action="store_true",
+                        help="only parse nodes.dmp at start, look up scientific names of assigned "
+                             "taxids in names.dmp when written, not used with --taxdmp, --snapshot "
+                             "or --shared")
+    snapshot_group = parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument("--snapshot", required=False,
+                                help="compiled taxonomy snapshot, it will be built from names and nodes if missing or stale")
+    snapshot_group.add_argument("--shared", required=False,
+                                help="name of taxonomy snapshot in POSIX shared memory, other runs with the same "
+                                     "name attach to it, it will be published from names and nodes if missing or stale")
+    parser.add_argument("-o", "--output", required=False, default="contigs_centrifuge_LCA.tsv",
+                        help="output file of LCA assigned taxonomy")
+    parser.add_argument("--stream", required=False, action="store_true",
+                        help="input is grouped by readID as centrifuge writes it, each read group is "
+                             "processed when it ends, memory use does not grow with input size, "
+                             "output is in input order")
+    parser.add_argument("--unsorted", required=False, action="store_true",
+                        help="input is not grouped by readID, e.g. merged from shards, records are "
+                             "spilled into temporary files by readID hash, each one is grouped "
+                             "within --memory, output is in the order of partitions")
+    parser.add_argument("--memory", required=False, type=int, default=1024,
+                        help="memory budget in MB for grouping one partition of --unsorted input")
+    parser.add_argument("--tmp_dir", required=False,
+                        help="directory for temporary partition files of --unsorted input")
+    parser.add_argument("-t", "--threads", required=False, type=int, default=1,
+                        help="number of worker processes, more than 1 process read groups in parallel, "
+                             "input must be grouped by readID as for --stream")
+    parser.add_argument("--checkpoint", required=False, type=int,
+                        help="seconds between checkpoints of how far the run got, 0 for every chunk, "
+                             "kept in OUTPUT.checkpoint, needs --stream or --threads")
+    parser.add_argument("--resume", required=False, action="store_true",
+                        help="go on from the checkpoint of an interrupted run with the same input "
+                             "and output, the output is the same as of an uninterrupted run")
+    parser.add_argument("--cache_size", required=False, type=int, default=100000,
+                        help="number of LCA results cached by set of hit taxids, 0 to disable")
+    parser.add_argument("--include_clade", required=False, action="append",
+                        help="taxid or scientific name of a clade, only hits under it are used for LCA, "
+                             "can be given more than once")
+    parser.add_argument("--exclude_clade", required=False, action="append",
+                        help="taxid or scientific name of a clade, hits under it are not used for LCA, "
+                             "can be given more than once")
+    parser.add_argument("-r", "--report", required=False,
+                        help="also write a kraken style abundance report, counts of sequences assigned "
+                             "to each taxon and to its clade, to this file")
+    args = parser.parse_args()
+    if args.unsorted and (args.stream or args.threads > 1):
+        parser.error("--unsorted can not be used with --stream or --threads")
+    if (args.checkpoint is not None or args.resume) and not (args.stream or args.threads > 1):
+        parser.error("--checkpoint and --resume need --stream or --threads")
 
     # with names.dmp and nodes.dmp files
-    Tax_ID = TaxIds(names="/data/shengwei/Alteromonas_meta/centrifuge/taxdmp/names.dmp", nodes="/data/shengwei/Alteromonas_meta/centrifuge/taxdmp/nodes.dmp")
+    snapshot = shared_snapshot_path(args.shared) if args.shared else args.snapshot
+    # clades given by name are looked up in the name index
+    clades = (args.include_clade or []) + (args.exclude_clade or [])
+    name_index = any(not clade.isdigit() for clade in clades)
+    for source in (args.names, args.nodes, args.taxdmp):
+        if source and not os.path.exists(source):
+            parser.error("%s is not found"%source)
+    has_source = args.taxdmp or (args.names and args.nodes)
+    # taxdmp.zip is only downloaded when asked for
+    if snapshot and not has_source and not args.download and not os.path.exists(snapshot):
+        if args.shared:
+            parser.error("shared taxonomy %s is not published, give --names and --nodes or --taxdmp "
+                         "to build it, or --download"%args.shared)
+        parser.error("snapshot %s is not found, give --names and --nodes or --taxdmp to build it, "
+                     "or --download"%snapshot)
+    if args.taxdmp:
+        Tax_ID = TaxIds(taxdmp=args.taxdmp, snapshot=snapshot, lca_index=True, lineage_table=True,
+                        name_index=name_index)
+    else:
+        # a snapshot is used as it is when not checked against taxdmp files
+        if not snapshot and not args.download:
+            args.names = args.names or DEFAULT_NAMES
+            args.nodes = args.nodes or DEFAULT_NODES
+        Tax_ID = TaxIds(names=args.names, nodes=args.nodes, snapshot=snapshot,
+                        lca_index=True, lineage_table=True, name_index=name_index,
+                        lazy_names=args.lazy_names, download=args.download)
     # no names.dmp or nodes.dmp supplied
     #Tax_ID = TaxIds()
 
-    centrifuge_records = CentrifugeRecordParser(sys.argv[1])
+    clade_filter = None
+    if clades:
+        try:
+            clade_filter = CladeFilter(Tax_ID, args.include_clade, args.exclude_clade)
+        except ValueError as e:
+            parser.error(str(e))
+
+    cache = LRUCache(args.cache_size)
+    lca_counts = {} # {lca taxid: number of sequences}
+
+    # go on from the last checkpoint, output after it is dropped
+    checkpoint = None
+    resumed = None
+    start = 0
+    if args.checkpoint is not None or args.resume:
+        checkpoint = Checkpoint(args.output+".checkpoint", args.input_centrifuge_output,
+                                CHECKPOINT_INTERVAL if args.checkpoint is None else args.checkpoint)
+    if args.resume:
+        try:
+            resumed = checkpoint.load()
+        except ValueError as e:
+            parser.error(str(e))
+        if resumed is None:
+            print "No checkpoint of %s is found, start from the beginning"%args.output
+    if resumed is not None:
+        start, output_size, lca_counts = resumed
+        print "Resume from byte %d of %s"%(start, args.input_centrifuge_output)
+        oh = open(args.output, "r+b")
+        oh.truncate(output_size)
+        oh.seek(output_size)
+    else:
+        oh = open(args.output, "w")
+        oh.write(HEADER)
+
+    with oh:
+        if args.threads > 1:
+            run_parallel(Tax_ID, args.input_centrifuge_output, oh, args.threads, cache, lca_counts,
+                         clade_filter, start, checkpoint)
+
+        elif args.stream:
+            # typed columns of read groups, in chunks of limited size, a
+            # checkpoint may follow each chunk
+            chunks = load_centrifuge_columns(args.input_centrifuge_output,
+                                             byte_range=(start, os.path.getsize(args.input_centrifuge_output)))
+            for columns in chunks:
+                for batch in iter_lca_batches_columnar([columns], clade_filter):
+                    count_lca(lca_counts, write_lca_batch(Tax_ID, oh, batch, cache))
+                if checkpoint is not None:
+                    checkpoint.save(oh, columns.end, lca_counts)
 
-    # prepare contigs_dict
-    contigs_dict = {}# {contigID:[centrifugeRecord1, centrifugeRecord2, ..]}
-    for rec in centrifuge_records:
-        if rec.readID in contigs_dict:
-            if int(rec.taxID) != 0 and int(rec.score) >= 100:
-                contigs_dict[rec.readID].append(rec)
-            else:
-                continue
         else:
-            if int(rec.taxID) != 0 and int(rec.score) >= 100:
-                contigs_dict[rec.readID] = [rec]
+            if args.unsorted:
+                # read groups of one hash partition of input at a time
+                chunks = partition_read_groups(args.input_centrifuge_output, args.memory << 20,
+                                               args.tmp_dir)
+                batches = iter_lca_batches_columnar(chunks, clade_filter)
             else:
-                continue
-
-    # write out lca assigned taxonomy for each contig
-    with open("contigs_centrifuge_LCA.tsv", "w") as oh:
-        oh.write("#ContigID\tLCA_TaxID\tLCA_SciName\tLCA_Rank\tLCA_Path\tMaxScore\tSuperkingdom\tphylum\tclass\torder\tfamily\tgenus\n")
-        for contig, hits in contigs_dict.iteritems():
-
-            # get all scores of each hit, find the max score, set 0.98*max as cutoff for LCA
-            rec_scores = [int(hit.score) for hit in hits]
-            max_score = max(rec_scores)
-            cutoff_score = int(max_score * 0.98)
-            rec_taxIDs = [int(hit.taxID) for hit in hits if hit.score >= cutoff_score]
-
-            # LCA analysis
-            lca_taxid = Tax_ID.get_lca(rec_taxIDs)
-            lca_scientificName = Tax_ID.get_sciName(lca_taxid)
-            lca_rank = Tax_ID.get_rank(lca_taxid)
-            lca_path = Tax_ID.get_path(lca_taxid, toStr=False)
-
-            # get superkingdom
-            superkingdom = Tax_ID.get_query_rank_from_path(lca_path, "superkingdom", toStr=True)
-            if not superkingdom:
-                superkingdom = "None"
-
-            # get phylum
-            phylum = Tax_ID.get_query_rank_from_path(lca_path, "phylum", toStr=True)
-            if not phylum:
-                phylum = "None"
-
-            # get class
-            _class = Tax_ID.get_query_rank_from_path(lca_path, "class", toStr=True)
-            if not _class:
-                _class = Tax_ID.get_query_rank_from_path(lca_path, "subclass", toStr=True)
-            if not _class:
-                _class = "None"
-
-            # get order
-            order = Tax_ID.get_query_rank_from_path(lca_path, "order", toStr=True)
-            if not order:
-                order = "None"
-
-            # get family
-            family = Tax_ID.get_query_rank_from_path(lca_path, "family", toStr=True)
-            if not family:
-                family = "None"
-
-            # get genus
-            genus = Tax_ID.get_query_rank_from_path(lca_path, "genus", toStr=True)
-            if not genus:
-                genus = "None"
-
+                # prepare contigs_dict
+                centrifuge_records = CentrifugeRecordParser(args.input_centrifuge_output)
+                contigs_dict = {}# {contigID:[centrifugeRecord1, centrifugeRecord2, ..]}
+                for rec in centrifuge_records:
+                    if not is_valid_hit(rec):
+                        continue
+                    if clade_filter is not None and not clade_filter.keep_taxid(int(rec.taxID)):
+                        continue
+                    if rec.readID in contigs_dict:
+                        contigs_dict[rec.readID].append(rec)
+                    else:
+                        contigs_dict[rec.readID] = [rec]
+                batches = iter_lca_batches(contigs_dict.iteritems())
 
+            for batch in batches:
+                count_lca(lca_counts, write_lca_batch(Tax_ID, oh, batch, cache))
+    if checkpoint is not None:
+        checkpoint.remove()
+    print cache
 
-            lca_path = Tax_ID.get_path(lca_taxid, toStr=True)
-            oh.write(contig+"\t"+str(lca_taxid)+"\t"+lca_scientificName+"\t"+lca_rank+"\t"+lca_path+"\t"+str(max_score)+"\t"+superkingdom+"\t"+phylum+"\t"+_class+"\t"+order+"\t"+family+"\t"+genus+"\n")
+    # abundance report of LCA assignments
+    if args.report:
+        taxids = lca_counts.keys()
+        with open(args.report, "w") as oh:
+            Tax_ID.write_abundance_report(oh, np.array(taxids, dtype=np.int64),
+                                          np.array([lca_counts[taxid] for taxid in taxids], dtype=np.int64))
 
 
 
 if __name__ == '__main__':
     main()
-
@@ -21,15 +21,39 @@ import sys
 import subprocess
 import os
 import argparse
-from utils.Fastq import parse_fastq
+import tempfile
+from itertools import islice, izip, izip_longest
+from utils.Fastq import iter_fastq_pairs, open_fastq_output, normalize_read_name, FastqIndex, ReadNameSet, \
+    READ_NAME_CHUNK_SIZE
 
 
-def write_fastq_records(input_fwd_fastq, input_rev_fastq, fastq_header_set, prefix):
+def get_output_files(input_fastqs, prefix, compress=False):
+    """
+    :param input_fastqs: input fastq files
+    :param prefix: output prefix of extracted fastq
+    :param compress: if True, add .gz to output files which have none
+    :return: list of output files
+    """
+    output_files = []
+    for fastq_file in input_fastqs:
+        basename = os.path.basename(fastq_file)
+        output_file = prefix + basename
+        if compress and not output_file.endswith(".gz"):
+            output_file += ".gz"
+        output_files.append(output_file)
+    return output_files
+
+
+def write_fastq_records(input_fwd_fastq, input_rev_fastq, fastq_header_set, prefix, threads=0, compress=False):
     """
     :param input_fwd_fastq: input forward reads in fastq format
     :param input_rev_fastq: input reverse reads in fastq format
-    :param fastq_header_set: input a set of fastq headers
+    :param fastq_header_set: input ReadNameSet of fastq headers
     :param prefix: output prefix of extracted fastq
+    :param threads: number of threads (de)compressing gzip input and output
+                    in background, 0 to do it in the calling thread
+    :param compress: if True, write BGZF compressed output, output of gzip
+                     input is always compressed
     :return: Nonething
 
     @FCC57ARACXX:1:1103:6389:21631#/2
@@ -37,36 +61,74 @@ def write_fastq_records(input_fwd_fastq, input_rev_fastq, fastq_header_set, pref
     +
     a_aecce`egggghddffhfdffidhcbhfhhgb`gfhhhfggdgiihiifggghihihgfheeWaeghhhhhhffffhi_geggb_aaZ_bc^a_aabb
     """
-    for fastq_file in (input_fwd_fastq, input_rev_fastq):
-        basename = os.path.basename(fastq_file)
-        output_file = prefix + basename
-
-        with open(output_file, "w") as oh:
-            fastq_records = parse_fastq(fastq_file)
-            for record in fastq_records:
-                name = record.header.rstrip("/1").rstrip("/2")
-                #print name
-                if name in fastq_header_set:
-                    oh.write(str(record))
-
-
-def get_fastq_headers(input_bam, input_contigs):
+    output_files = get_output_files((input_fwd_fastq, input_rev_fastq), prefix, compress)
+
+    # both mates of a pair are kept or dropped together, in one pass
+    with open_fastq_output(output_files[0], threads) as fwd_oh, \
+         open_fastq_output(output_files[1], threads) as rev_oh:
+        pairs = iter_fastq_pairs(input_fwd_fastq, input_rev_fastq, threads=threads)
+        while True:
+            # names of a chunk of pairs are looked up at once
+            chunk = list(islice(pairs, READ_NAME_CHUNK_SIZE))
+            if not chunk:
+                break
+            for (name, fwd, rev), keep in izip(chunk, fastq_header_set.contains([pair[0] for pair in chunk])):
+                if keep:
+                    fwd_oh.write(str(fwd.to_fastq()))
+                    rev_oh.write(str(rev.to_fastq()))
+
+
+def fetch_fastq_records(input_fwd_fastq, input_rev_fastq, fastq_header_set, prefix, threads=0, compress=False):
+    """ same as write_fastq_records(), but seek to the reads through a name
+        index of each fastq file, FASTQ.fqi, built on first use, instead of
+        reading both files through
+    :param input_fwd_fastq: input forward reads, plain or BGZF compressed
+    :param input_rev_fastq: input reverse reads, plain or BGZF compressed
+    :param fastq_header_set: input ReadNameSet of fastq headers
+    :param prefix: output prefix of extracted fastq
+    :param threads: number of threads decompressing input to build index,
+                    and compressing output
+    :param compress: if True, write BGZF compressed output
+    :return: Nonething
     """
+    output_files = get_output_files((input_fwd_fastq, input_rev_fastq), prefix, compress)
+    fwd_index = FastqIndex(input_fwd_fastq, threads=threads)
+    rev_index = FastqIndex(input_rev_fastq, threads=threads)
+
+    with open_fastq_output(output_files[0], threads) as fwd_oh, \
+         open_fastq_output(output_files[1], threads) as rev_oh:
+        # both are in file order, mates come in the same order
+        for (name, fwd), (rev_name, rev) in izip_longest(fwd_index.fetch(fastq_header_set),
+                                                          rev_index.fetch(fastq_header_set),
+                                                          fillvalue=(None, None)):
+            if name != rev_name:
+                raise ValueError("Reads of %s and %s are not paired: %s, %s"%(
+                                 input_fwd_fastq, input_rev_fastq, name, rev_name))
+            fwd_oh.write(str(fwd))
+            rev_oh.write(str(rev))
+
+
+def get_fastq_headers(input_bam, input_contigs, bloom_bits=0):
+    """ read names are hashed as they stream out of samtools, the whole
+        output is never held in memory, a QNAME is normalized as fastq
+        headers are, see normalize_read_name()
     :param input_bam:     input bam file contains read alignment to contigs
     :param input_contigs: a subset of interested contigs
-    :param prefix: output prefix
-    :return:  a set of fastq headers
+    :param bloom_bits:    bits of Bloom filter per read name, 0 for none,
+                          see ReadNameSet
+    :return:  a ReadNameSet of fastq headers
     """
-    fastq_headers = []
-
-    p = subprocess.Popen(["bash", "slice_bam_by_contigs.sh", input_bam, input_contigs],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-
-    for header in stdout.split("\n"):
-        fastq_headers.append(header.strip())
+    # stderr goes to a file, a full stderr pipe would stall samtools
+    with tempfile.TemporaryFile() as err:
+        p = subprocess.Popen(["bash", "slice_bam_by_contigs.sh", input_bam, input_contigs],
+                             stdout=subprocess.PIPE, stderr=err)
+        fastq_headers = ReadNameSet((normalize_read_name(line) for line in p.stdout), bloom_bits)
+        p.stdout.close()
+        if p.wait() != 0:
+            err.seek(0)
+            raise IOError("Cannot slice %s by contigs of %s: %s"%(input_bam, input_contigs, err.read().strip()))
 
-    return set(fastq_headers)
+    return fastq_headers
 
 
 def main():
@@ -78,14 +140,28 @@ def main():
     parser.add_argument("fwd_fastq", help="the forward fastq reads")
     parser.add_argument("rev_fastq", help="the reverse fastq reads")
     parser.add_argument("-p", "--prefix", required=False, default="extracted_", help="the output prefix of extracted fastq files")
+    parser.add_argument("-z", "--gzip", required=False, action="store_true",
+                        help="compress extracted fastq files, output of gzip compressed input is always compressed")
+    parser.add_argument("-i", "--index", required=False, action="store_true",
+                        help="fetch reads through a name index of each fastq file, FASTQ.fqi, built on first "
+                             "use, instead of reading them through, gzip input must be BGZF compressed")
+    parser.add_argument("-t", "--threads", required=False, type=int, default=2,
+                        help="number of threads decompressing gzip input and compressing output in background, "
+                             "0 to do it in the main thread")
+    parser.add_argument("-b", "--bloom_bits", required=False, type=int, default=0,
+                        help="bits of Bloom filter per read name put before the exact read name lookup, "
+                             "about 10 speeds up lookups of hundreds of millions of names, 0 for none")
 
     args = parser.parse_args()
 
     # get headers
-    fastq_header_set = get_fastq_headers(args.input_bam, args.interest_contigs)
+    fastq_header_set = get_fastq_headers(args.input_bam, args.interest_contigs, args.bloom_bits)
 
     # write fastq for given headers
-    write_fastq_records(args.fwd_fastq, args.rev_fastq, fastq_header_set, args.prefix)
+    if args.index:
+        fetch_fastq_records(args.fwd_fastq, args.rev_fastq, fastq_header_set, args.prefix, args.threads, args.gzip)
+    else:
+        write_fastq_records(args.fwd_fastq, args.rev_fastq, fastq_header_set, args.prefix, args.threads, args.gzip)
 
 
 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+
+# Copyright (C) 2016  Shengwei Hou : housw2010 'at' gmail 'dot' com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+from utils.Taxonomy import TaxIds
+from utils.TaxonomyServer import TaxonomyServer, DEFAULT_SOCKET
+
+
+def main():
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description="load NCBI taxonomy once, and serve queries from TaxIdsClient over a Unix domain socket")
+    parser.add_argument("--names", required=False, help="names.dmp of NCBI taxonomy, taxdmp.zip will be downloaded if not given")
+    parser.add_argument("--nodes", required=False, help="nodes.dmp of NCBI taxonomy, taxdmp.zip will be downloaded if not given")
+    parser.add_argument("--taxdmp", required=False, help="taxdmp.zip of NCBI taxonomy, used if names and nodes are not given, "
+                                                         "downloaded if missing")
+    parser.add_argument("--snapshot", required=False,
+                        help="compiled taxonomy snapshot, it will be built from names and nodes if missing or stale")
+    parser.add_argument("--synonyms", required=False, action="store_true",
+                        help="also look up taxids by synonyms in names.dmp, not only by scientific names")
+    parser.add_argument("-s", "--socket", required=False, default=DEFAULT_SOCKET, help="Unix domain socket to listen on")
+    args = parser.parse_args()
+
+    Tax_ID = TaxIds(names=args.names, nodes=args.nodes, taxdmp=args.taxdmp, snapshot=args.snapshot,
+                    lca_index=True, lineage_table=True, name_index=True, name_synonyms=args.synonyms)
+
+    server = TaxonomyServer(Tax_ID, args.socket)
+    print "Serving taxonomy on %s, press Ctrl-C to stop ..."%args.socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+
+if __name__ == "__main__":
+    main()
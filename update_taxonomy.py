@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+
+# Copyright (C) 2016  Shengwei Hou : housw2010 'at' gmail 'dot' com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import argparse
+from utils.Taxonomy import TaxIds
+
+
+def main():
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description="update a compiled taxonomy snapshot to a newer NCBI taxdmp release, "
+                                                 "and report the changed taxids")
+    parser.add_argument("snapshot", help="compiled taxonomy snapshot to update")
+    parser.add_argument("--names", required=False, help="new names.dmp of NCBI taxonomy")
+    parser.add_argument("--nodes", required=False, help="new nodes.dmp of NCBI taxonomy")
+    parser.add_argument("--merged", required=False, help="new merged.dmp of NCBI taxonomy")
+    parser.add_argument("--taxdmp", required=False, help="new taxdmp.zip of NCBI taxonomy, used if names and nodes "
+                                                         "are not given, the latest one is downloaded if none is given")
+    parser.add_argument("-c", "--changes", required=False, help="write one line per changed taxid to this file")
+    args = parser.parse_args()
+
+    if bool(args.names) != bool(args.nodes):
+        parser.error("--names and --nodes must be given together")
+    if not os.path.exists(args.snapshot):
+        sys.exit("Taxonomy snapshot %s does not exist"%args.snapshot)
+
+    # open the snapshot as it is, without checking it against any taxdmp
+    Tax_ID = TaxIds(snapshot=args.snapshot)
+    report = Tax_ID.update(names=args.names, nodes=args.nodes, merged=args.merged, taxdmp=args.taxdmp)
+    Tax_ID.compile(args.snapshot)
+    print report
+
+    if args.changes:
+        with open(args.changes, "w") as oh:
+            report.write(oh)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+
+# Copyright (C) 2016  Shengwei Hou : housw2010 'at' gmail 'dot' com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sys
+import zlib
+import struct
+import threading
+import Queue
+import numpy as np
+
+
+# uncompressed data per BGZF block, small enough for the compressed block to
+# stay below 64 KB even for incompressible data
+BGZF_BLOCK_DATA = 65280
+
+# BGZF blocks decompressed by one task of a worker thread
+BGZF_BLOCKS_PER_TASK = 16
+
+# empty BGZF block marking the end of file
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# compressed input read per step of a single gzip stream
+GZIP_READ_SIZE = 1 << 20
+
+
+def is_bgzf(path):
+    """ check whether a gzip file is BGZF, blocks of at most 64 KB each with
+        its compressed size in the gzip header, as written by bgzip
+    :param path: gzip compressed file
+    :return:     True if path starts with a BGZF block
+    """
+    with open(path, "rb") as ih:
+        header = ih.read(18)
+    return len(header) == 18 and header[:4] == "\x1f\x8b\x08\x04" and header[12:14] == "BC"
+
+
+def _read_bgzf_block(ih):
+    """ read one whole BGZF block
+    :param ih: opened BGZF file
+    :return:   (block, offset of deflate data in block), None at end of file
+    """
+    header = ih.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+        raise IOError("Not a BGZF block at byte %d"%(ih.tell() - len(header)))
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = ih.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[i+2:i+4])[0]
+        if extra[i:i+2] == "BC" and slen == 2:
+            bsize = struct.unpack("<H", extra[i+4:i+6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise IOError("BGZF block at byte %d has no block size"%(ih.tell() - 12 - len(extra)))
+    rest = ih.read(bsize + 1 - 12 - xlen)
+    if len(rest) != bsize + 1 - 12 - xlen:
+        raise IOError("BGZF block at byte %d is truncated"%(ih.tell() - 12 - len(extra) - len(rest)))
+    return header + extra + rest, 12 + xlen
+
+
+def inflate_bgzf_block(block, start):
+    """ decompress one BGZF block, and check its crc32 and size
+    :param block: whole BGZF block
+    :param start: offset of deflate data in block
+    :return:      uncompressed data
+    """
+    data = zlib.decompress(block[start:-8], -zlib.MAX_WBITS)
+    crc, size = struct.unpack("<II", block[-8:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise IOError("BGZF block is corrupted")
+    return data
+
+
+def deflate_bgzf_block(data, level=6):
+    """ compress data, at most BGZF_BLOCK_DATA bytes, into one BGZF block
+    :param data:  uncompressed data
+    :param level: zlib compression level
+    :return:      BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def bgzf_block_table(path):
+    """ compressed and uncompressed start of every BGZF block, found from the
+        block headers and sizes without decompressing anything
+    :param path: BGZF file
+    :return:     (coffsets, uoffsets), numpy int64 arrays
+    """
+    coffsets = []
+    uoffsets = []
+    coffset = 0
+    uoffset = 0
+    with open(path, "rb") as ih:
+        while True:
+            header = ih.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[:4] != "\x1f\x8b\x08\x04" or header[12:14] != "BC":
+                raise IOError("Not a BGZF block at byte %d"%coffset)
+            bsize = struct.unpack("<H", header[16:18])[0]
+            ih.seek(coffset + bsize + 1 - 4)
+            isize = struct.unpack("<I", ih.read(4))[0]
+            coffsets.append(coffset)
+            uoffsets.append(uoffset)
+            coffset += bsize + 1
+            uoffset += isize
+    return np.array(coffsets, dtype=np.int64), np.array(uoffsets, dtype=np.int64)
+
+
+def virtual_offsets(positions, coffsets, uoffsets):
+    """ BGZF virtual offsets, compressed start of block << 16 | offset inside
+        uncompressed block, of positions in uncompressed data
+    :param positions: numpy array of uncompressed positions
+    :param coffsets:  compressed start of blocks, from bgzf_block_table()
+    :param uoffsets:  uncompressed start of blocks, from bgzf_block_table()
+    :return:          numpy uint64 array
+    """
+    # empty blocks share their start with the next one, take the last of them
+    i = np.searchsorted(uoffsets, positions, side="right") - 1
+    return (coffsets[i].astype(np.uint64) << np.uint64(16)) | (positions - uoffsets[i]).astype(np.uint64)
+
+
+class BgzfFile(object):
+    """ random access to a BGZF file by virtual offsets, see virtual_offsets(),
+        the last decompressed block is kept, so nearby reads are cheap. Only
+        seek() and readline() of a file are supported.
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self._ih = open(path, "rb")
+        self._block_start = None
+        self._next_block = 0
+        self._data = ""
+        self._pos = 0
+
+    def _load_block(self, coffset):
+        if coffset == self._block_start:
+            return
+        self._ih.seek(coffset)
+        block = _read_bgzf_block(self._ih)
+        self._block_start = coffset
+        self._next_block = self._ih.tell() if block is not None else None
+        self._data = inflate_bgzf_block(*block) if block is not None else ""
+
+    def seek(self, voffset):
+        self._load_block(int(voffset) >> 16)
+        self._pos = int(voffset) & 0xffff
+
+    def readline(self):
+        parts = []
+        while True:
+            end = self._data.find("\n", self._pos)
+            if end >= 0:
+                parts.append(self._data[self._pos:end+1])
+                self._pos = end + 1
+                break
+            parts.append(self._data[self._pos:])
+            self._pos = len(self._data)
+            if self._next_block is None:
+                break
+            self._load_block(self._next_block)
+            self._pos = 0
+        return "".join(parts)
+
+    def close(self):
+        self._ih.close()
+
+
+def _inflate_task(blocks):
+    return "".join([inflate_bgzf_block(block, start) for block, start in blocks])
+
+
+class _OrderedWorkers(object):
+    """ run func over items in worker threads, zlib releases the GIL while it
+        (de)compresses, results come out in the order items were submitted,
+        submit() blocks while max_pending results are not taken yet
+    """
+
+    def __init__(self, func, threads, max_pending):
+        self._func = func
+        self._tasks = Queue.Queue()
+        self._pending = Queue.Queue(max_pending)
+        self._threads = [threading.Thread(target=self._work) for _ in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        for slot, item in iter(self._tasks.get, (None, None)):
+            try:
+                slot[1] = self._func(item)
+            except Exception:
+                slot[2] = sys.exc_info()
+            slot[0].set()
+
+    def submit(self, item):
+        slot = [threading.Event(), None, None]
+        self._pending.put(slot)
+        self._tasks.put((slot, item))
+
+    def finish(self):
+        """ no more items will be submitted
+        """
+        self._pending.put(None)
+
+    def results(self):
+        """ yield results in order of submit(), until finish()
+        """
+        for slot in iter(self._pending.get, None):
+            slot[0].wait()
+            if slot[2] is not None:
+                raise slot[2][0], slot[2][1], slot[2][2]
+            yield slot[1]
+
+    def close(self):
+        for _ in self._threads:
+            self._tasks.put((None, None))
+        for thread in self._threads:
+            thread.join()
+
+
+class ThreadedGzipReader(object):
+    """ read a gzip file, decompressed in background threads while the caller
+        parses, decompressed chunks are handed over through a bounded queue.
+        BGZF blocks are decompressed in parallel by worker threads, any
+        other gzip file, with one or more members, by one background thread,
+        as the member boundaries of plain gzip are only known by
+        decompressing it. Only read() and close() of a file are supported.
+    """
+
+    def __init__(self, path, threads=2, queue_size=8):
+        """
+        :param path:       gzip compressed file
+        :param threads:    number of threads decompressing BGZF blocks
+        :param queue_size: max number of decompressed chunks waiting to be read
+        """
+        self.name = path
+        self._queue = Queue.Queue(queue_size)
+        self._buffer = ""
+        self._eof = False
+        self._closed = threading.Event()
+        self._feed_error = None
+        self._fed = False
+        self._workers = _OrderedWorkers(_inflate_task, max(1, threads), max(2, threads*2)) \
+                        if is_bgzf(path) else None
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _bgzf_chunks(self):
+        with open(self.name, "rb") as ih:
+            feeder = threading.Thread(target=self._feed_bgzf, args=(ih,))
+            feeder.daemon = True
+            feeder.start()
+            for data in self._workers.results():
+                yield data
+            self._fed = True
+            feeder.join()
+        if self._feed_error is not None:
+            raise self._feed_error[0], self._feed_error[1], self._feed_error[2]
+
+    def _feed_bgzf(self, ih):
+        try:
+            blocks = []
+            while not self._closed.is_set():
+                block = _read_bgzf_block(ih)
+                if block is not None:
+                    blocks.append(block)
+                if blocks and (block is None or len(blocks) == BGZF_BLOCKS_PER_TASK):
+                    self._workers.submit(blocks)
+                    blocks = []
+                if block is None:
+                    break
+        except Exception:
+            if not self._closed.is_set():
+                self._feed_error = sys.exc_info()
+        finally:
+            self._workers.finish()
+
+    def _gzip_chunks(self):
+        with open(self.name, "rb") as ih:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while not self._closed.is_set():
+                data = ih.read(GZIP_READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    out = decompressor.decompress(data)
+                    if out:
+                        yield out
+                    data = decompressor.unused_data
+                    # next member, zero padding after the last one is ignored
+                    if data and data.strip("\x00"):
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    else:
+                        data = ""
+            out = decompressor.flush()
+            if out:
+                yield out
+
+    def _produce(self):
+        try:
+            chunks = self._bgzf_chunks() if self._workers is not None else self._gzip_chunks()
+            for data in chunks:
+                if self._closed.is_set():
+                    break
+                self._queue.put(data)
+        except Exception:
+            self._queue.put(sys.exc_info())
+        finally:
+            self._queue.put(None)
+
+    def _next_chunk(self):
+        data = self._queue.get()
+        if data is None:
+            self._eof = True
+            return ""
+        if isinstance(data, tuple):
+            self._eof = True
+            raise data[0], data[1], data[2]
+        return data
+
+    def read(self, size=-1):
+        """ read up to size bytes of decompressed data, all of it if size < 0
+        """
+        chunks = [self._buffer]
+        have = len(self._buffer)
+        while not self._eof and (size < 0 or have < size):
+            data = self._next_chunk()
+            chunks.append(data)
+            have += len(data)
+        data = "".join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._closed.set()
+        # unblock the producer, it may wait for room in queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self._workers is not None:
+            # unblock the feeder, it may wait for results to be taken
+            if not self._fed:
+                try:
+                    for _ in self._workers.results():
+                        pass
+                except Exception:
+                    pass
+                self._fed = True
+            self._workers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ThreadedBgzfWriter(object):
+    """ write a BGZF file, compressed by worker threads in blocks of
+        BGZF_BLOCK_DATA bytes, and written in order by a background thread.
+        BGZF is gzip with many members, any gzip reader can read it.
+    """
+
+    def __init__(self, path, threads=2, level=6):
+        """
+        :param path:    output file
+        :param threads: number of threads compressing blocks
+        :param level:   zlib compression level
+        """
+        self.name = path
+        self._level = level
+        self._oh = open(path, "wb")
+        self._buffer = []
+        self._buffered = 0
+        self._workers = _OrderedWorkers(self._deflate, max(1, threads), max(2, threads*4))
+        self._error = None
+        self._thread = threading.Thread(target=self._write_blocks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _deflate(self, data):
+        return deflate_bgzf_block(data, self._level)
+
+    def _write_blocks(self):
+        try:
+            for block in self._workers.results():
+                self._oh.write(block)
+        except Exception:
+            self._error = sys.exc_info()
+            # keep taking results, so submit() does not block forever
+            for _ in self._workers.results():
+                pass
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def write(self, data):
+        self._check()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BGZF_BLOCK_DATA:
+            data = "".join(self._buffer)
+            end = len(data) - len(data) % BGZF_BLOCK_DATA
+            for start in range(0, end, BGZF_BLOCK_DATA):
+                self._workers.submit(data[start:start+BGZF_BLOCK_DATA])
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+
+    def close(self):
+        if self._oh.closed:
+            return
+        try:
+            if self._buffered:
+                self._workers.submit("".join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            self._workers.finish()
+            self._thread.join()
+            self._workers.close()
+            self._check()
+            self._oh.write(BGZF_EOF)
+        finally:
+            self._oh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -18,6 +18,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import shutil
+import tempfile
+import zlib
+import numpy as np
+
+
+# memory used to group one partition, as a multiple of its size on disk, see
+# partition_read_groups()
+PARTITION_MEMORY_FACTOR = 10
+
+# at most this many partition files are open at once
+MAX_PARTITIONS = 1000
+
+
 class CentrifugeRecord(object):
     """ This class used to represent centrifuge records in tabular result
 
@@ -28,7 +43,7 @@ class CentrifugeRecord(object):
     __slots__=["readID", "uniqueID", "taxID", "score", "secBestScore",
                "hitLength", "numMatches"]
 
-    record_dict = {} # {readID:CentrifugeRecord}
+    record_dict = {} # {readID:[CentrifugeRecord, ...]}, filled by CentrifugeRecordParser(keep_records=True)
 
     def __init__(self, readID, uniqueID, taxID, score, secBestScore, hitLength, numMatches):
         self.readID = readID
@@ -39,11 +54,6 @@ class CentrifugeRecord(object):
         self.hitLength = hitLength
         self.numMatches = numMatches
 
-        if not self.readID in CentrifugeRecord.record_dict:
-            CentrifugeRecord.record_dict[self.readID] = [self]
-        else:
-            CentrifugeRecord.record_dict[self.readID].append(self)
-
     def __str__(self):
         return self.readID +"\t"+self.uniqueID+"\t"+\
                str(self.taxID)+"\t"+str(self.score)+"\t"+str(self.secBestScore)+\
@@ -53,10 +63,14 @@ class CentrifugeRecord(object):
 class CentrifugeRecordParser(object):
     """ parse centrifuge results as a generator
     """
-    def __init__(self, fh):
+    def __init__(self, fh, keep_records=False):
         """This parser is used to parse centrifuge result
+        :param fh:           centrifuge result file or opened file handle
+        :param keep_records: if True, every parsed record is also kept in
+                             CentrifugeRecord.record_dict, memory grows with input
         """
         self.handle = fh
+        self.keep_records = keep_records
 
     def _yield_records(self):
         """ This function used to yield Centrifuge record one by one
@@ -83,7 +97,213 @@ class CentrifugeRecordParser(object):
                 print "Warning: the fields number of line %d is not 7, will be passed!!"%i
                 print line
                 continue
-            yield CentrifugeRecord(*line)
+            rec = CentrifugeRecord(*line)
+            if self.keep_records:
+                CentrifugeRecord.record_dict.setdefault(rec.readID, []).append(rec)
+            yield rec
 
     def __iter__(self):
-        return self._yield_records()
\ No newline at end of file
+        return self._yield_records()
+
+
+def split_read_groups(centrifuge_file, n_chunks):
+    """ split centrifuge result file into byte ranges at read group
+        boundaries, all hits of a read stay in one range
+    :param centrifuge_file: centrifuge result file, grouped by readID
+    :param n_chunks:        number of ranges wanted, fewer ranges are returned
+                            for small files
+    :return:                list of (start, end) byte ranges covering the file
+    """
+    size = os.path.getsize(centrifuge_file)
+    bounds = [0]
+    with open(centrifuge_file, "rb") as ih:
+        for i in range(1, n_chunks):
+            pos = max(size*i//n_chunks, bounds[-1])
+            if pos >= size:
+                break
+            # move to the start of next full line
+            ih.seek(pos)
+            if pos > 0:
+                ih.readline()
+            # move on to the first line of the next read
+            pos = ih.tell()
+            line = ih.readline()
+            readID = line.split("\t", 1)[0]
+            while line and line.split("\t", 1)[0] == readID:
+                pos = ih.tell()
+                line = ih.readline()
+            if not line:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+class CentrifugeColumns(object):
+    """ a chunk of centrifuge records in typed columns, column i of every
+        array belongs to the i-th record, records of a read are consecutive
+
+        readIDs:   readID of each read group in this chunk
+        read_code: index into readIDs of each record
+        end:       byte offset in file right after this chunk, set by
+                   load_centrifuge_columns(), reading can go on from there
+    """
+    __slots__ = ["readIDs", "read_code", "uniqueID", "taxID", "score",
+                 "secBestScore", "hitLength", "numMatches", "end"]
+
+    def __init__(self, readIDs, read_code, uniqueID, taxID, score, secBestScore, hitLength, numMatches):
+        self.readIDs = readIDs
+        self.read_code = read_code
+        self.uniqueID = uniqueID
+        self.taxID = taxID
+        self.score = score
+        self.secBestScore = secBestScore
+        self.hitLength = hitLength
+        self.numMatches = numMatches
+        self.end = None
+
+    def __len__(self):
+        return len(self.read_code)
+
+
+def _parse_int_column(fields):
+    """ convert a list of integer strings into int64 array
+    """
+    ret = np.fromstring(" ".join(fields), dtype=np.int64, sep=" ")
+    # fromstring stops at the first bad value, let numpy report it
+    if len(ret) != len(fields):
+        ret = np.array(fields, dtype=np.int64)
+    return ret
+
+
+def _lines_to_columns(lines):
+    """ parse a list of centrifuge lines into CentrifugeColumns
+    """
+    n_lines = len(lines)
+    lines = [line for line in lines if line and line[0] not in " \t\r" and
+             not line.startswith("readID")]
+    good = [line for line in lines if line.count("\t") == 6]
+    if len(good) != len(lines):
+        print "Warning: %d lines do not have 7 fields, will be passed!!"%(len(lines) - len(good))
+    if not good:
+        return None
+
+    fields = "\t".join(good).replace("\r", "").split("\t")
+    readIDs = np.array(fields[0::7])
+    group_start = np.ones(len(good), dtype=bool)
+    group_start[1:] = readIDs[1:] != readIDs[:-1]
+    read_code = np.cumsum(group_start) - 1
+    return CentrifugeColumns(readIDs[group_start], read_code, np.array(fields[1::7]),
+                             *[_parse_int_column(fields[i::7]) for i in range(2, 7)])
+
+
+def load_centrifuge_columns(centrifuge_file, chunk_bytes=8<<20, byte_range=None):
+    """ read centrifuge result in large chunks into typed columns, a read
+        group is never split between two chunks
+    :param centrifuge_file: centrifuge result file
+    :param chunk_bytes:     approximate size of text parsed per chunk
+    :param byte_range:      (start, end), only parse lines starting in this
+                            range of file, see split_read_groups()
+    :return:                yield CentrifugeColumns as a generator
+    """
+    start, end = byte_range if byte_range else (0, None)
+    with open(centrifuge_file, "rb") as ih:
+        ih.seek(start)
+        pos = start
+        carry = ""
+        while True:
+            size = chunk_bytes if end is None else min(chunk_bytes, end - pos)
+            block = ih.read(size) if size > 0 else ""
+            pos += len(block)
+            eof = not block
+            block = carry + block
+            if not block:
+                break
+
+            lines = block.split("\n")
+            # keep the last, maybe partial line, and the read group of the last
+            # full line, which may go on in next block, for next chunk
+            if not eof:
+                last = len(lines) - 1
+                if last > 0:
+                    readID = lines[last-1].split("\t", 1)[0]
+                    while last > 0 and lines[last-1].split("\t", 1)[0] == readID:
+                        last -= 1
+                # a single read group larger than chunk, read on
+                if last == 0:
+                    carry = block
+                    continue
+                carry = "\n".join(lines[last:])
+                lines = lines[:last]
+            else:
+                carry = ""
+
+            columns = _lines_to_columns(lines)
+            if columns is not None:
+                columns.end = pos - len(carry)
+                yield columns
+            if eof:
+                break
+
+
+def partition_read_groups(centrifuge_file, memory_bytes, tmp_dir=None):
+    """ group records of centrifuge result which is not grouped by readID,
+        e.g. merged from shards or re-sorted, in limited memory: records are
+        spilled into temporary partition files by hash of readID, then each
+        partition is grouped in memory on its own
+    :param centrifuge_file: centrifuge result file, in any order
+    :param memory_bytes:    memory budget for grouping one partition, the
+                            number of partitions is chosen to keep each of
+                            them below it, a single read larger than the
+                            budget still ends up in one partition
+    :param tmp_dir:         directory for partition files, removed when done
+    :return:                yield CentrifugeColumns, one per partition, records
+                            of a read are consecutive and in input order
+    """
+    size = os.path.getsize(centrifuge_file)
+    n_partitions = max(1, -(-size*PARTITION_MEMORY_FACTOR // max(memory_bytes, 1)))
+    if n_partitions > MAX_PARTITIONS:
+        print "Warning: %d partitions needed for the memory budget, only %d will be used, "\
+              "partitions may be larger than the budget"%(n_partitions, MAX_PARTITIONS)
+        n_partitions = MAX_PARTITIONS
+
+    # it fits, no spill
+    if n_partitions == 1:
+        with open(centrifuge_file, "rb") as ih:
+            lines = ih.read().split("\n")
+        columns = _group_lines(lines)
+        if columns is not None:
+            yield columns
+        return
+
+    spill_dir = tempfile.mkdtemp(prefix="centrifuge_partitions.", dir=tmp_dir)
+    try:
+        paths = [os.path.join(spill_dir, "partition_%d.tsv"%i) for i in range(n_partitions)]
+        partitions = [open(path, "wb") for path in paths]
+        try:
+            with open(centrifuge_file, "rb") as ih:
+                for line in ih:
+                    readID = line[:line.find("\t")]
+                    partitions[(zlib.crc32(readID) & 0xffffffff) % n_partitions].write(line)
+        finally:
+            for oh in partitions:
+                oh.close()
+
+        for path in paths:
+            with open(path, "rb") as ih:
+                lines = ih.read().split("\n")
+            os.remove(path)
+            columns = _group_lines(lines)
+            if columns is not None:
+                yield columns
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def _group_lines(lines):
+    """ parse centrifuge lines in any order into CentrifugeColumns, grouped by
+        readID, the sort is stable so hits of a read keep their order
+    """
+    lines.sort(key=lambda line: line[:line.find("\t")])
+    return _lines_to_columns(lines)
@@ -17,7 +17,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import gzip
+from hashlib import md5
+from itertools import chain, imap, islice, izip, izip_longest, repeat
+from operator import itemgetter
+import numpy as np
+from collections import OrderedDict
+from .Bgzf import ThreadedGzipReader, ThreadedBgzfWriter, BgzfFile, is_bgzf, bgzf_block_table, virtual_offsets
+from .Snapshot import write_snapshot, read_snapshot
+
+
+# FASTQ text is read in blocks of about this size, larger blocks do not
+# parse faster once the newline scan of a block falls out of CPU cache
+FASTQ_BLOCK_SIZE = 1 << 20
+
+# read names hashed at once when building a ReadNameSet, or looking pairs up in it
+READ_NAME_CHUNK_SIZE = 1 << 16
+
+# header line without its '@'
+_drop_at = itemgetter(slice(1, None))
 
 
 class Fastq(object):
@@ -49,26 +68,500 @@ class Fastq(object):
                + self.qual + "\n"
 
 
-def parse_fastq(fastq_file):
+class FastqRecord(tuple):
+    """ light FASTQ record from iter_fastq_records(), a tuple of
+
+        (block, start, header_end, seq_end, end)
+
+        the block of text it was read from, the offset of its '@', of the
+        newlines ending its header and sequence lines, and of its last
+        newline in block. Fields are sliced out of block only when asked
+        for, str() gives the record text as it is in file. A record keeps
+        its whole block alive, use to_fastq() to keep it for long. Records
+        of text with CRLF line ends are _CrlfFastqRecord.
+    """
+    __slots__ = ()
+
+    @property
+    def header(self):
+        return self[0][self[1]+1:self[2]]
+
+    @property
+    def seq(self):
+        return self[0][self[2]+1:self[3]]
+
+    @property
+    def qual(self):
+        block, start, header_end, seq_end, end = self
+        return block[block.rfind("\n", seq_end, end)+1:end]
+
+    def to_fastq(self):
+        """ eager Fastq object of this record
+        """
+        return Fastq(self.header.strip(), self.seq.strip(), self.qual.strip())
+
+    def __repr__(self):
+        return 'FastqRecord(header=%s, seq=%s, qual=%s)' % (self.header, self.seq, self.qual)
+
+    def __str__(self):
+        return self[0][self[1]:self[4]+1]
+
+
+class _CrlfFastqRecord(FastqRecord):
+    """ FastqRecord of a block with CRLF line ends, the '\r' before each
+        newline is not part of the fields, as in eager Fastq objects
+    """
+    __slots__ = ()
+
+    @property
+    def header(self):
+        return self[0][self[1]+1:self[2]].rstrip("\r")
+
+    @property
+    def seq(self):
+        return self[0][self[2]+1:self[3]].rstrip("\r")
+
+    @property
+    def qual(self):
+        block, start, header_end, seq_end, end = self
+        return block[block.rfind("\n", seq_end, end)+1:end].rstrip("\r")
+
+
+def _record_class(block):
+    """ FastqRecord class of records in block, which only needs to strip
+        '\r' from fields if block has any
+    """
+    return _CrlfFastqRecord if "\r" in block else FastqRecord
+
+
+def open_fastq(fastq_file, threads=0):
+    """ open plain or gzip compressed fastq file for read
+    :param fastq_file: input fastq file, compressed if it ends with .gz
+    :param threads:    if 0, decompress in the calling thread, otherwise
+                       decompress in background, BGZF by this many threads,
+                       see ThreadedGzipReader
+    :return:           opened file
+    """
+    if fastq_file.endswith(".gz"):
+        if threads:
+            return ThreadedGzipReader(fastq_file, threads)
+        return gzip.open(fastq_file, "rb")
+    return open(fastq_file, "rb")
+
+
+def open_fastq_output(fastq_file, threads=0):
+    """ open fastq file for write, BGZF compressed if it ends with .gz
+    :param fastq_file: output fastq file
+    :param threads:    number of threads compressing output, see
+                       ThreadedBgzfWriter, 0 for a plain gzip file written
+                       in the calling thread
+    :return:           opened file
+    """
+    if fastq_file.endswith(".gz"):
+        if threads:
+            return ThreadedBgzfWriter(fastq_file, threads)
+        return gzip.open(fastq_file, "wb")
+    return open(fastq_file, "wb")
+
+
+def _record_layout(offset, block, head, newlines):
+    """ check the records of block that start at head, and end at every
+        fourth of newlines
+    :return: (offset, block, starts, newlines) of iter_fastq_blocks()
+    """
+    text = np.frombuffer(block, dtype=np.uint8)
+    ends = newlines[3::4]
+    starts = np.empty_like(ends)
+    starts[0] = head
+    starts[1:] = ends[:-1] + 1
+    bad = np.flatnonzero((text[starts] != ord("@")) | (text[newlines[1::4]+1] != ord("+")))
+    if len(bad):
+        raise ValueError("Line at byte %d is not the start of a fastq record"%(offset + starts[bad[0]]))
+    return offset, block, starts, newlines
+
+
+def iter_fastq_blocks(fastq_file, block_size=FASTQ_BLOCK_SIZE, threads=0):
+    """ read fastq text in large blocks of whole records, record boundaries
+        are found for all records of a block at once, every record is four
+        lines, header, sequence, '+' and quality
+    :param fastq_file: input fastq file, or opened file
+    :param block_size: approximate size of text read per block
+    :param threads:    decompression threads of gzip input, see open_fastq()
+    :return:           yield (offset, block, starts, newlines), offset of block
+                       in uncompressed text, block of text, numpy arrays of
+                       the offset of '@' of each record in block, and of the
+                       newlines of its records, four per record. A record
+                       split by two reads comes alone in a small block of its
+                       own, blocks as read are not copied, which costs more
+                       than finding their newlines
+    """
+    ih = fastq_file if hasattr(fastq_file, "read") else open_fastq(fastq_file, threads)
+    try:
+        offset = 0
+        carry = ""
+        data = ih.read(block_size)
+        while data:
+            next_data = ih.read(block_size)
+            # only blank lines left, read on to see if they end the file
+            while next_data and not next_data.strip("\r\n"):
+                more = ih.read(block_size)
+                next_data = next_data + more if more else ""
+            if not next_data:
+                # the last record may miss its newline, blank lines after it are ignored
+                data = data.rstrip("\r\n") + "\n"
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+
+            # the record begun at the end of the read before
+            head = 0
+            if carry:
+                need = 4 - carry.count("\n")
+                # a record larger than block, read on
+                if len(newlines) < need:
+                    carry += data
+                    offset += len(data)
+                    data = next_data
+                    continue
+                head = int(newlines[need-1]) + 1
+                record = carry + data[:head]
+                yield _record_layout(offset - len(carry), record, 0,
+                                     np.flatnonzero(np.frombuffer(record, dtype=np.uint8) == 10))
+                newlines = newlines[need:]
+
+            n = len(newlines) - len(newlines) % 4
+            if n:
+                yield _record_layout(offset, data, head, newlines[:n])
+                head = int(newlines[n-1]) + 1
+            carry = data[head:]
+            offset += len(data)
+            data = next_data
+
+        if carry.rstrip("\r\n"):
+            raise ValueError("Fastq record at byte %d is truncated"%(offset - len(carry)))
+    finally:
+        if ih is not fastq_file:
+            ih.close()
+
+
+def _block_records(block_info):
+    """ FastqRecord of every record in one block of iter_fastq_blocks()
+    """
+    _, block, starts, newlines = block_info
+    record_class = _record_class(block)
+    return imap(tuple.__new__, repeat(record_class), izip(repeat(block), starts.tolist(), newlines[0::4].tolist(),
+                                                          newlines[1::4].tolist(), newlines[3::4].tolist()))
+
+
+def iter_fastq_records(fastq_file, block_size=FASTQ_BLOCK_SIZE, threads=0):
+    """ fast fastq parser, records are FastqRecord views on large blocks of
+        text, created without any per record work in python
+    :param fastq_file: input fastq file, or opened file
+    :param block_size: approximate size of text read per block
+    :param threads:    decompression threads of gzip input, see open_fastq()
+    :return:           yield FastqRecord as a generator
+    """
+    return chain.from_iterable(imap(_block_records, iter_fastq_blocks(fastq_file, block_size, threads)))
+
+
+def _block_fastqs(block_info):
+    """ eager Fastq of every record in one block of iter_fastq_blocks()
+    """
+    _, block, starts, newlines = block_info
+    lines = block[starts[0]:newlines[-1]].split("\n")
+    return imap(Fastq, imap(_drop_at, imap(str.strip, lines[0::4])),
+                imap(str.strip, lines[1::4]), imap(str.strip, lines[3::4]))
+
+
+def parse_fastq(fastq_file, eager=True, block_size=FASTQ_BLOCK_SIZE, threads=0):
     """
     :param fastq_file: input fastq file
+    :param eager:      if True, yield Fastq objects, otherwise yield the light
+                       FastqRecord of iter_fastq_records(), which is much
+                       faster when only some fields are used
+    :param block_size: approximate size of text read per block
+    :param threads:    decompression threads of gzip input, see open_fastq()
     :return:           yield Fastq record as a generator
     """
+    if not eager:
+        return iter_fastq_records(fastq_file, block_size, threads)
+    return chain.from_iterable(imap(_block_fastqs, iter_fastq_blocks(fastq_file, block_size, threads)))
 
-    # handle gzip compressed file
-    if fastq_file.endswith(".gz"):
-        ih = gzip.open(fastq_file, "r")
-    else:
-        ih = open(fastq_file, "r")
-
-    # parse fastq records
-    header = ih.readline().strip()[1:]
-    while header:
-        header = header.strip()[1:]
-        seq = ih.readline().strip()
-        ih.readline()
-        qual = ih.readline().strip()
-        yield Fastq(header, seq, qual)
-        header = ih.readline()
-
-    ih.close()
\ No newline at end of file
+
+def normalize_read_name(header):
+    """ read name shared by both mates, the first word of header without a
+        /1 or /2 mate suffix, Casava 1.8 headers keep the mate in a comment:
+
+        FCC57ARACXX:1:1103:6389:21631#0/2       -> FCC57ARACXX:1:1103:6389:21631#0
+        HWI-ST1234:8:1101:1234:5678 2:N:0:ATCAC -> HWI-ST1234:8:1101:1234:5678
+    :param header: fastq header, without '@'
+    :return:       read name
+    """
+    words = header.split(None, 1)
+    if not words:
+        return ""
+    name = words[0]
+    if name.endswith("/1") or name.endswith("/2"):
+        return name[:-2]
+    return name
+
+
+def iter_fastq_pairs(fwd_fastq, rev_fastq, eager=False, block_size=FASTQ_BLOCK_SIZE, threads=0):
+    """ read both mates of paired-end fastq files in lock step, each pair is
+        checked to be mates of the same read
+    :param fwd_fastq:  forward reads in fastq format
+    :param rev_fastq:  reverse reads in fastq format, in the same order
+    :param eager:      if True, yield Fastq objects, otherwise FastqRecord
+    :param block_size: approximate size of text read per block
+    :param threads:    decompression threads of gzip input, see open_fastq()
+    :return:           yield (read name, forward record, reverse record), read
+                       name from normalize_read_name()
+    """
+    fwd_records = parse_fastq(fwd_fastq, eager, block_size, threads)
+    rev_records = parse_fastq(rev_fastq, eager, block_size, threads)
+    for i, (fwd, rev) in enumerate(izip_longest(fwd_records, rev_records)):
+        if fwd is None or rev is None:
+            raise ValueError("%s has more reads than %s"%((fwd_fastq, rev_fastq) if rev is None else
+                                                          (rev_fastq, fwd_fastq)))
+        name = normalize_read_name(fwd.header)
+        if name != normalize_read_name(rev.header):
+            raise ValueError("Read %d of %s and %s are not mates: %s, %s"%(
+                             i+1, fwd_fastq, rev_fastq, fwd.header, rev.header))
+        yield name, fwd, rev
+
+
+def read_name_hash(name):
+    """ 64 bit hash of a read name, the first 8 bytes of its md5 digest
+    :param name: read name, see normalize_read_name()
+    :return:     hash as an integer
+    """
+    return int(np.frombuffer(md5(name).digest()[:8], dtype="<u8")[0])
+
+
+def hash_read_names(names):
+    """ read_name_hash() of many names at once
+    :param names: iterable of read names
+    :return:      numpy uint64 array
+    """
+    digests = "".join([md5(name).digest()[:8] for name in names])
+    return np.frombuffer(digests, dtype="<u8").astype(np.uint64)
+
+
+class ReadNameSet(object):
+    """ set of read names kept as their read_name_hash(), sorted and unique,
+        8 bytes per name instead of a python string of ~100 bytes, so that
+        hundreds of millions of names fit in memory
+
+        names are looked up in batches by a vectorized binary search, an
+        optional Bloom filter answers most names not in the set before it,
+        which touches a few bytes of memory instead of a whole binary search
+
+        a 64 bit hash may collide, a name not in the set is reported in it
+        with a probability of about len(self)/2**64
+    """
+
+    def __init__(self, names=(), bloom_bits=0, chunk_size=READ_NAME_CHUNK_SIZE):
+        """
+        :param names:      iterable of read names, see normalize_read_name(),
+                           consumed chunk by chunk, so it may be a stream
+        :param bloom_bits: bits of Bloom filter per name, about 10 rejects
+                           99% of names not in the set, 0 for no filter
+        :param chunk_size: number of names hashed at once
+        """
+        hashes = []
+        names = iter(names)
+        while True:
+            chunk = [name for name in islice(names, chunk_size) if name]
+            if not chunk:
+                break
+            # duplicates dropped early, a read aligns more than once
+            hashes.append(np.unique(hash_read_names(chunk)))
+        self._hash = np.unique(np.concatenate(hashes)) if hashes else np.zeros(0, dtype=np.uint64)
+        self._bloom = None
+        self._bloom_mask = None
+        self._bloom_k = 0
+        if bloom_bits > 0 and len(self._hash):
+            self._build_bloom(bloom_bits)
+
+    def _build_bloom(self, bloom_bits):
+        """ Bloom filter of 2**n bits, bloom_bits*ln(2) bit positions per name
+        """
+        nbits = 1 << max(int(np.ceil(np.log2(len(self._hash)*bloom_bits))), 6)
+        self._bloom = np.zeros(nbits >> 3, dtype=np.uint8)
+        self._bloom_mask = np.uint64(nbits - 1)
+        self._bloom_k = max(1, int(round(bloom_bits*np.log(2))))
+        for start in xrange(0, len(self._hash), READ_NAME_CHUNK_SIZE):
+            for pos in self._bloom_positions(self._hash[start:start+READ_NAME_CHUNK_SIZE]):
+                np.bitwise_or.at(self._bloom, pos >> 3, np.left_shift(1, pos & 7).astype(np.uint8))
+
+    def _bloom_positions(self, hashes):
+        """ bit positions of hashes, by double hashing of the low and high
+            32 bits, as the md5 bits of a hash are independent
+        :return: yield one uint64 array of positions per bit of a name
+        """
+        low = hashes & np.uint64(0xffffffff)
+        step = (hashes >> np.uint64(32)) | np.uint64(1)
+        for i in range(self._bloom_k):
+            yield (low + np.uint64(i)*step) & self._bloom_mask
+
+    def __len__(self):
+        return len(self._hash)
+
+    def __contains__(self, name):
+        return bool(self.contains_hashes(hash_read_names([name]))[0])
+
+    def contains(self, names):
+        """ membership of many read names at once
+        :param names: list of read names
+        :return:      numpy bool array, one per name
+        """
+        return self.contains_hashes(hash_read_names(names))
+
+    def contains_hashes(self, hashes):
+        """ membership of many read_name_hash() values at once
+        :param hashes: numpy uint64 array
+        :return:       numpy bool array, one per hash
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        found = np.zeros(len(hashes), dtype=bool)
+        if not len(self._hash):
+            return found
+        candidates = np.arange(len(hashes))
+        if self._bloom is not None:
+            keep = np.ones(len(hashes), dtype=bool)
+            for pos in self._bloom_positions(hashes):
+                keep &= (self._bloom[pos >> 3] >> (pos & 7).astype(np.uint8)) & 1 == 1
+            candidates = candidates[keep]
+        # exact answer of names passing the filter
+        hashes = hashes[candidates]
+        idx = np.searchsorted(self._hash, hashes)
+        idx[idx == len(self._hash)] = 0
+        found[candidates[self._hash[idx] == hashes]] = True
+        return found
+
+
+class FastqIndex(object):
+    """ on-disk index of a fastq file, the position of every record keyed by
+        read_name_hash() of its normalized read name, both sorted by hash:
+
+        hash:   read name hashes, sorted
+        offset: byte offset of record in a plain fastq file, or its BGZF
+                virtual offset in a BGZF compressed one, see virtual_offsets()
+
+        a 64 bit hash may collide, fetched records are checked by name
+    """
+
+    def __init__(self, fastq_file, index_file=None, threads=0):
+        """
+        :param fastq_file: plain or BGZF compressed fastq file, BGZF is what
+                           bgzip and ThreadedBgzfWriter write
+        :param index_file: index file, FASTQ.fqi if not given, it is opened by
+                           mmap if it matches fastq_file, otherwise (re)built
+        :param threads:    decompression threads used to build the index
+        """
+        self.fastq_file = fastq_file
+        self.index_file = index_file or fastq_file + ".fqi"
+        self.bgzf = fastq_file.endswith(".gz")
+        if self.bgzf and not is_bgzf(fastq_file):
+            raise ValueError("%s is gzip but not BGZF compressed, it can not be indexed, "
+                             "recompress it with bgzip"%fastq_file)
+        self._hash = None
+        self._offset = None
+        if not self._open(self.index_file):
+            self._build(threads)
+            self.compile(self.index_file)
+
+    def _stamp(self):
+        st = os.stat(self.fastq_file)
+        return [st.st_size, int(st.st_mtime)]
+
+    def _open(self, index_file):
+        """ open index if it matches fastq file
+        :return: True if opened
+        """
+        if not os.path.exists(index_file):
+            return False
+        try:
+            ret = read_snapshot(index_file)
+        except Exception as e:
+            print "Cannot read fastq index %s: %s"%(index_file, e)
+            return False
+        if ret is None or ret[0].get("stamp") != self._stamp() or "hash" not in ret[1]:
+            print "Fastq index %s is stale, will be rebuilt"%index_file
+            return False
+        self._hash = ret[1]["hash"]
+        self._offset = ret[1]["offset"]
+        return True
+
+    def _build(self, threads):
+        """ hash the read name of every record
+        """
+        hashes = []
+        positions = []
+        for offset, block, starts, newlines in iter_fastq_blocks(self.fastq_file, threads=threads):
+            headers = block[starts[0]:newlines[-1]].split("\n")[0::4]
+            hashes.append(hash_read_names([normalize_read_name(header[1:]) for header in headers]))
+            positions.append(starts + offset)
+        hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+        positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+        if self.bgzf:
+            offsets = virtual_offsets(positions, *bgzf_block_table(self.fastq_file))
+        else:
+            offsets = positions.astype(np.uint64)
+        order = np.argsort(hashes, kind="mergesort")
+        self._hash = hashes[order]
+        self._offset = offsets[order]
+
+    def compile(self, index_file):
+        """ write the index into index_file
+        """
+        sections = OrderedDict()
+        sections["hash"] = self._hash
+        sections["offset"] = self._offset
+        write_snapshot(index_file, sections, {"stamp": self._stamp(), "bgzf": self.bgzf})
+
+    def __len__(self):
+        return len(self._hash)
+
+    def get_offsets(self, names):
+        """ offsets of records whose read name hash matches one of names
+        :param names: iterable of read names, see normalize_read_name(), or a
+                      ReadNameSet, its names are not known, read name None
+        :return:      list of (offset, read name), sorted by offset
+        """
+        if isinstance(names, ReadNameSet):
+            offsets = self._offset[names.contains_hashes(self._hash)]
+            return [(offset, None) for offset in np.sort(offsets).tolist()]
+        names = sorted(set(names))
+        hashes = hash_read_names(names)
+        lo = np.searchsorted(self._hash, hashes, side="left")
+        hi = np.searchsorted(self._hash, hashes, side="right")
+        found = []
+        for name, start, end in zip(names, lo.tolist(), hi.tolist()):
+            for offset in self._offset[start:end].tolist():
+                found.append((offset, name))
+        found.sort()
+        return found
+
+    def fetch(self, names, eager=True):
+        """ read the records of given read names by seeking to them
+        :param names: iterable of read names, see normalize_read_name(), or a
+                      ReadNameSet, whose hash collisions can not be told apart
+        :param eager: if True, yield Fastq objects, otherwise FastqRecord
+        :return:      yield (read name, record) in file order
+        """
+        ih = BgzfFile(self.fastq_file) if self.bgzf else open(self.fastq_file, "rb")
+        try:
+            for offset, name in self.get_offsets(names):
+                ih.seek(offset)
+                text = "".join([ih.readline() for _ in range(4)])
+                if not text.endswith("\n"):
+                    text += "\n"
+                header_end = text.find("\n")
+                record = _record_class(text)((text, 0, header_end, text.find("\n", header_end+1), len(text)-1))
+                if name is None:
+                    name = normalize_read_name(record.header)
+                # a hash collision
+                elif normalize_read_name(record.header) != name:
+                    continue
+                yield name, record.to_fastq() if eager else record
+        finally:
+            ih.close()
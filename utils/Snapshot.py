@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+
+# <Snapshot.py, named numpy arrays in one binary file opened by mmap>
+# Copyright (C) <2016>  <Shengwei Hou> <housw2010'at'gmail'dot'com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import mmap
+import struct
+import numpy as np
+
+
+#-------------------------------------------------------------#
+#     binary snapshot, written once, opened by mmap           #
+#-------------------------------------------------------------#
+
+# layout: magic, version, header length, json header, then each section
+# aligned to _SNAPSHOT_ALIGN bytes, sections are described in the header
+_SNAPSHOT_MAGIC = "VAHTAXDB"
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_ALIGN = 64
+
+
+def write_snapshot(snapshot, sections, meta):
+    """ write named arrays into a binary snapshot file
+    :param snapshot: output snapshot file
+    :param sections: OrderedDict {name: numpy array or str}
+    :param meta:     dict of json serializable info stored in header
+    :return:         None
+    """
+    header = dict(meta)
+    header["version"] = _SNAPSHOT_VERSION
+    header["sections"] = {}
+
+    # compute offsets of each section, header size depends on offsets, so
+    # reserve enough room for the header first
+    layout = []
+    for name, data in sections.iteritems():
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            layout.append((name, data, {"dtype": data.dtype.str, "shape": list(data.shape)}))
+        else:
+            layout.append((name, data, {"dtype": "bytes", "shape": [len(data)]}))
+    reserve = len(json.dumps(dict(header, sections=dict(
+        (name, dict(info, offset=2**62, nbytes=2**62)) for name, _, info in layout))))
+
+    def _align(pos):
+        return (pos + _SNAPSHOT_ALIGN - 1) // _SNAPSHOT_ALIGN * _SNAPSHOT_ALIGN
+
+    pos = _align(len(_SNAPSHOT_MAGIC) + 8 + reserve)
+    for name, data, info in layout:
+        info["offset"] = pos
+        info["nbytes"] = data.nbytes if isinstance(data, np.ndarray) else len(data)
+        header["sections"][name] = info
+        pos = _align(pos + info["nbytes"])
+    header_str = json.dumps(header).ljust(reserve)
+
+    # write to a temporary file, then rename, so readers never see half a file
+    tmp_file = snapshot + ".tmp%d"%os.getpid()
+    with open(tmp_file, "wb") as oh:
+        oh.write(_SNAPSHOT_MAGIC)
+        oh.write(struct.pack("<II", _SNAPSHOT_VERSION, len(header_str)))
+        oh.write(header_str)
+        for name, data, info in layout:
+            oh.write("\0"*(info["offset"] - oh.tell()))
+            oh.write(data.tobytes() if isinstance(data, np.ndarray) else data)
+    os.rename(tmp_file, snapshot)
+
+
+def read_snapshot(snapshot):
+    """ open a binary snapshot file with mmap, sections are not copied
+    :param snapshot: input snapshot file
+    :return:         (meta, {name: read-only numpy array or buffer}), or None if
+                     the file is not a snapshot of current version
+    """
+    with open(snapshot, "rb") as ih:
+        if ih.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+            return None
+        version, header_len = struct.unpack("<II", ih.read(8))
+        if version != _SNAPSHOT_VERSION:
+            return None
+        meta = json.loads(ih.read(header_len))
+        mm = mmap.mmap(ih.fileno(), 0, access=mmap.ACCESS_READ)
+
+    sections = {}
+    for name, info in meta.pop("sections").iteritems():
+        if info["dtype"] == "bytes":
+            sections[name] = buffer(mm, info["offset"], info["nbytes"])
+        else:
+            dtype = np.dtype(str(info["dtype"]))
+            sections[name] = np.frombuffer(mm, dtype=dtype, count=info["nbytes"]//dtype.itemsize,
+                                           offset=info["offset"]).reshape(info["shape"])
+    return meta, sections
@@ -19,16 +19,251 @@
 
 
 import subprocess
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 import sys
 import os
-import Bio.Phylo as bp
-from Bio.Phylo import Newick
+import hashlib
+import mmap
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+import numpy as np
+from .Snapshot import write_snapshot, read_snapshot
 try:
     from cStringIO import StringIO
 except Exception:
     from StringIO import StringIO
 
 
+def _as_taxid(taxid):
+    """ convert a query taxid into integer
+    :param taxid: input query taxid, int or str
+    :return:      integer taxid, None if it cannot be converted
+    """
+    if type(taxid) == int:
+        return taxid
+    try:
+        return int(str(taxid).strip())
+    except Exception as e:
+        print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+
+
+# block size of the LCA range minimum index, see TaxIds.build_lca_index()
+_LCA_BLOCK = 32
+
+# canonical ranks of the lineage table, see TaxIds.build_lineage_table(), a
+# rank missing from the path is looked up in its fallback ranks in order
+LINEAGE_RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+LINEAGE_FALLBACKS = {"class": ["subclass"]}
+
+# rank codes in abundance report, see TaxIds.write_abundance_report()
+REPORT_RANK_CODES = {"superkingdom": "D", "kingdom": "K", "phylum": "P", "class": "C",
+                     "order": "O", "family": "F", "genus": "G", "species": "S"}
+
+# name classes of names.dmp indexed besides scientific names, if synonyms are
+# asked for, see TaxIds.build_name_index()
+NAME_INDEX_SYNONYMS = ["synonym", "equivalent name", "genbank synonym", "common name",
+                       "genbank common name", "acronym", "genbank acronym", "blast name"]
+
+# node labels written without quotes in newick, same as Bio.Phylo
+_NEWICK_LABEL = re.compile(r"[^\s\(\)\[\]\'\:\;\,]+$")
+
+
+def _file_checksum(files, chunk_size=1<<20):
+    """ md5 checksum over the content of files, in the given order
+    :param files: list of file paths
+    :return:      hex digest
+    """
+    md5 = hashlib.md5()
+    for f in files:
+        with open(f, "rb") as ih:
+            chunk = ih.read(chunk_size)
+            while chunk:
+                md5.update(chunk)
+                chunk = ih.read(chunk_size)
+    return md5.hexdigest()
+
+
+def _file_stamps(files):
+    """ cheap fingerprint of files, used to skip the checksum when unchanged
+    :param files: list of file paths
+    :return:      [[size, mtime], ...]
+    """
+    stamps = []
+    for f in files:
+        st = os.stat(f)
+        stamps.append([st.st_size, int(st.st_mtime)])
+    return stamps
+
+
+def _changed_names(old_offset, old_names, new_offset, new_names, block=4096):
+    """ taxids whose scientific names differ between two name stores of
+        TaxIds, runs of taxids with the same names are skipped by comparing
+        the concatenated names of the whole run
+    :param old_offset: _name_offset of one TaxIds
+    :param old_names:  _names of one TaxIds
+    :param new_offset: _name_offset of the other TaxIds
+    :param new_names:  _names of the other TaxIds
+    :param block:      taxids compared at once
+    :return:           sorted numpy array of taxids
+    """
+    old_offset = np.asarray(old_offset, dtype=np.int64)
+    new_offset = np.asarray(new_offset, dtype=np.int64)
+    n = min(len(old_offset), len(new_offset)) - 1
+    changed = []
+    ranges = [(start, min(start+block, n)) for start in range(0, n, block)]
+    while ranges:
+        start, end = ranges.pop()
+        old_run = old_offset[start:end+1] - old_offset[start]
+        new_run = new_offset[start:end+1] - new_offset[start]
+        if np.array_equal(old_run, new_run) and \
+           old_names[old_offset[start]:old_offset[end]] == new_names[new_offset[start]:new_offset[end]]:
+            continue
+        if end - start > 16:
+            middle = (start + end) // 2
+            ranges.extend([(start, middle), (middle, end)])
+            continue
+        for taxid in range(start, end):
+            if old_names[old_offset[taxid]:old_offset[taxid+1]] != \
+               new_names[new_offset[taxid]:new_offset[taxid+1]]:
+                changed.append(taxid)
+    return np.array(sorted(changed), dtype=np.int64)
+
+
+def _newick_label(label):
+    """ quote a newick node label if needed, the same way as Bio.Phylo
+    """
+    if not label:
+        return ""
+    if not _NEWICK_LABEL.match(label):
+        return "'%s'"%label.replace("\\", "\\\\").replace("'", "\\'")
+    return label
+
+
+def _write_tree(oh, nodes, parents, labels, out_fmt="newick", flush_size=1<<16):
+    """ stream a tree given by parent pointers into newick or phyloxml,
+        without building any tree object, children are written in the
+        increasing order of node id, the output is the same as Bio.Phylo
+        writes for a tree without branch lengths
+    :param oh:         opened output file
+    :param nodes:      numpy array of integer node ids
+    :param parents:    numpy array of parent of each node, the root node is
+                       its own parent
+    :param labels:     list of label of each node
+    :param out_fmt:    newick / phyloxml
+    :param flush_size: number of pieces collected before each write
+    :return:           None
+    """
+    assert out_fmt in ("newick", "phyloxml"), "The out_fmt should be newick or phyloxml"
+    nodes = np.asarray(nodes, dtype=np.int64)
+    parents = np.asarray(parents, dtype=np.int64)
+    n = len(nodes)
+    if not n:
+        return
+
+    # children of each node, as a range of child, nodes are referred to by index
+    by_node = np.argsort(nodes, kind="mergesort")
+    found = np.minimum(np.searchsorted(nodes[by_node], parents), n-1)
+    assert (nodes[by_node[found]] == parents).all(), "Parent of some nodes is missing in the tree"
+    parent_index = by_node[found]
+    roots = np.flatnonzero(parent_index == np.arange(n))
+    assert len(roots) == 1, "The tree should have exactly one root, found %d"%len(roots)
+    child = np.flatnonzero(parent_index != np.arange(n))
+    child = child[np.lexsort((nodes[child], parent_index[child]))]
+    child_parent = parent_index[child]
+    starts = np.searchsorted(child_parent, np.arange(n)).tolist()
+    ends = np.searchsorted(child_parent, np.arange(n), side="right").tolist()
+    child = child.tolist()
+
+    out = []
+    if out_fmt == "newick":
+        labels = [_newick_label(label) + ":0.00000" for label in labels]
+        # stack of node index to open, ~index to close, None for a comma
+        stack = [int(roots[0])]
+        while stack:
+            i = stack.pop()
+            if i is None:
+                out.append(",")
+            elif i < 0:
+                out.append(")" + labels[~i])
+            elif starts[i] == ends[i]:
+                out.append(labels[i])
+            else:
+                out.append("(")
+                stack.append(~i)
+                for k in range(ends[i]-1, starts[i], -1):
+                    stack.append(child[k])
+                    stack.append(None)
+                stack.append(child[starts[i]])
+            if len(out) >= flush_size:
+                oh.write("".join(out))
+                del out[:]
+        out.append(";\n")
+    else:
+        out.append('<phyloxml xmlns="http://www.phyloxml.org" '
+                   'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                   'xsi:schemaLocation="http://www.phyloxml.org http://www.phyloxml.org/1.10/phyloxml.xsd">\n'
+                   '  <phylogeny rooted="false">\n')
+        # stack of (node index, depth) to open, (~index, depth) to close
+        stack = [(int(roots[0]), 2)]
+        while stack:
+            i, depth = stack.pop()
+            indent = "  "*depth
+            if i < 0:
+                out.append("%s</clade>\n"%indent)
+            else:
+                out.append("%s<clade>\n"%indent)
+                if labels[i]:
+                    out.append("%s  <name>%s</name>\n"%(indent, escape(labels[i])))
+                stack.append((~i, depth))
+                for k in range(ends[i]-1, starts[i]-1, -1):
+                    stack.append((child[k], depth+1))
+            if len(out) >= flush_size:
+                oh.write("".join(out))
+                del out[:]
+        out.append("  </phylogeny>\n</phyloxml>\n")
+    oh.write("".join(out))
+
+
+def _iter_zip_lines(archive, member, chunk_size=8<<20):
+    """ iterate lines of a file in zip archive, without extracting it, the
+        member is decompressed in large chunks instead of line by line
+    :param archive:    opened zipfile.ZipFile
+    :param member:     name of file in archive
+    :param chunk_size: bytes decompressed per read
+    :return:           generator of lines, with line endings
+    """
+    fh = archive.open(member, "r")
+    try:
+        tail = ""
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            end = chunk.rfind("\n") + 1
+            tail = chunk[end:]
+            for line in StringIO(chunk[:end]):
+                yield line
+        if tail:
+            yield tail
+    finally:
+        fh.close()
+
+
+def shared_snapshot_path(name):
+    """ path of a taxonomy snapshot published into POSIX shared memory, on
+        Linux shm_open() keeps named segments as files in /dev/shm
+    :param name: name of shared memory segment
+    :return:     path of shared memory segment
+    """
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(shm_dir, name)
+
+
 class GI_TaxID():
     """ convert GI number to TaxID
     """
@@ -43,29 +278,375 @@ class GI_TaxID():
 
 
 
+class TaxonomyUpdate(object):
+    """ taxids changed by TaxIds.update(), each a sorted numpy array:
+
+        added:    new taxids
+        deleted:  taxids removed, not merged into others
+        merged:   taxids removed, merged into others, see merged.dmp
+        moved:    taxids with a new parent
+        renamed:  taxids with a new scientific name
+        reranked: taxids with a new rank
+        affected: added, moved and reranked taxids and their descendants,
+                  their paths, lineages and LCA results may have changed
+    """
+
+    _changes = ["added", "deleted", "merged", "moved", "renamed", "reranked"]
+
+    def __init__(self):
+        for change in self._changes + ["affected"]:
+            setattr(self, change, np.zeros(0, dtype=np.int64))
+        self.lca_index = "not built"
+        self.lineage_table = "not built"
+        self.name_index = "not built"
+
+    def write(self, oh):
+        """ write one line per changed taxid:
+
+            change    taxid
+        :param oh: opened output file
+        :return:   None
+        """
+        for change in self._changes:
+            for taxid in getattr(self, change):
+                oh.write("%s\t%d\n"%(change, taxid))
+
+    def __str__(self):
+        counts = ", ".join("%d %s"%(len(getattr(self, change)), change) for change in self._changes)
+        return "Taxonomy update: %s, %d taxids affected; LCA index %s, lineage table %s, name index %s"%(
+               counts, len(self.affected), self.lca_index, self.lineage_table, self.name_index)
+
+
 class TaxIds(object):
     """ This class used to store taxid, sciName, parentTaxid and rank
         info, a path2file need as input to initialize. lines in path2file
         looks like below:
 
         taxid    scientificName    parentTaxid    rank\n
+
+        the taxonomy is kept in compact arrays indexed by taxid instead of
+        a {taxid: [sciName, parent, rank]} dict:
+
+        _parent:      parent taxid of each taxid, 0 if taxid is not in nodes.dmp
+        _rank:        rank code of each taxid, decoded by _rank_names
+        _name_offset: sciName of taxid t is _names[_name_offset[t]:_name_offset[t+1]]
+        _names:       all scientific names concatenated into one string
+
+        with lazy_names, _name_offset and _names stay unloaded until some
+        method needs all names, sciNames are looked up in names.dmp instead
     """
 
     _taxdmp_ftp = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdmp.zip"
 
-    def __init__(self, names=None, nodes=None, merged=None):
+    def __init__(self, names=None, nodes=None, merged=None, snapshot=None, lca_index=False,
+                 lineage_table=False, taxdmp=None, name_index=False, name_synonyms=False,
+                 lazy_names=False, download=True):
+        """
+        :param names:     names.dmp file, taxdmp.zip will be used if not given
+        :param nodes:     nodes.dmp file, taxdmp.zip will be used if not given
+        :param merged:    merged.dmp file, a taxid merged into another one is
+                          looked up as the taxid it was merged into
+        :param snapshot:  compiled taxonomy snapshot, it will be opened by mmap if
+                          it matches names and nodes, otherwise it will be
+                          (re)built from names and nodes
+        :param lca_index: if True, build the constant time LCA index, see
+                          build_lca_index(), and keep it in snapshot
+        :param lineage_table: if True, build the rank lineage table of
+                          LINEAGE_RANKS, see build_lineage_table(), and keep
+                          it in snapshot
+        :param taxdmp:    local taxdmp.zip, names.dmp and nodes.dmp are read
+                          from it without extraction, it will be downloaded
+                          if names, nodes and taxdmp are all not given
+        :param name_index: if True, build the index of scientific names for
+                          lookup of taxids by name, see build_name_index(),
+                          and keep it in snapshot
+        :param name_synonyms: if True, the name index also covers the names of
+                          NAME_INDEX_SYNONYMS classes in names.dmp
+        :param lazy_names: if True, only nodes.dmp is parsed at start, the
+                          sciName of a taxid is looked up in the memory mapped
+                          names.dmp when asked for, which suits jobs that only
+                          walk the tree and name a few taxids at the end. Not
+                          used with taxdmp.zip or snapshot, names are loaded
+                          anyway by them
+        :param download:  if False, taxdmp.zip is never downloaded, an IOError
+                          is raised instead when the taxonomy has to be built
+                          and names, nodes and taxdmp are all not given
+        """
         self.names = names
         self.nodes = nodes
+        self.taxdmp = taxdmp
         self.merged = merged
-        self.container = self._update_taxid_dict()
+        self.snapshot = snapshot
+        self.download = download
+        self._parent = None
+        self._rank = None
+        self._rank_names = [None] # rank code 0 means no rank info
+        self._name_offset = None
+        self._names = ""
+        self._lazy_names = None # _LazyNames, if names are not loaded yet
+        self._source = None
+        self._merged_old = None # taxids merged into others, sorted
+        self._merged_new = None # taxid each of _merged_old was merged into
+        self._preorder = None   # pre-order position of each taxid, -1 if not under root
+        self._order = None      # taxids in pre-order
+        self._lca_keys = None   # (depth << _lca_bits | position) in pre-order
+        self._lca_bits = 0
+        self._lca_prefix = None # prefix minimum of _lca_keys inside each block
+        self._lca_suffix = None # suffix minimum of _lca_keys inside each block
+        self._lca_table = None  # sparse table over block minimum of _lca_keys
+        self._subtree_end = None # end of subtree of each pre-order position, exclusive
+        self._lineage = None    # ancestor taxid at each lineage rank, rank x taxid
+        self.lineage_ranks = []
+        self.lineage_fallbacks = {}
+        self._name_index = None # names of name index, sorted case-insensitively, concatenated
+        self._name_index_offset = None
+        self._name_index_taxid = None
+        self._name_index_scientific = None
+        self.name_synonyms = False
+        updated = False
+        if not (snapshot and self._open_snapshot(snapshot)):
+            self._update_taxid_store(lazy_names=lazy_names and not snapshot)
+            updated = True
+        if lca_index and self._lca_keys is None:
+            self.build_lca_index()
+            updated = True
+        if lineage_table and self._lineage is None:
+            self.build_lineage_table()
+            updated = True
+        if name_index and (self._name_index is None or name_synonyms and not self.name_synonyms):
+            self.build_name_index(synonyms=name_synonyms)
+            updated = True
+        if snapshot and updated:
+            self.compile(snapshot)
+        self.container = _TaxIdContainer(self)
+
+    def _source_files(self):
+        """ the taxdmp files this taxonomy is built from, None if downloaded
+        """
+        if self.names and self.nodes:
+            return [self.names, self.nodes] + ([self.merged] if self.merged else [])
+        if self.taxdmp:
+            return [self.taxdmp]
+
+    def _source_info(self):
+        """ checksum and file stamps of the taxdmp files, stored in snapshot
+        """
+        if self._source is None:
+            files = self._source_files()
+            if files:
+                self._source = {"md5": _file_checksum(files), "stamps": _file_stamps(files)}
+            else:
+                self._source = {}
+        return self._source
 
-    def _update_taxid_dict(self, dir=os.getcwd()):
+    def _is_snapshot_fresh(self, source):
+        """ check whether a snapshot was compiled from the current taxdmp files
+        :param source: source info recorded in snapshot
+        :return:       True if snapshot can be used
+        """
+        files = self._source_files()
+        # nothing to compare with, use what was compiled before
+        if not files:
+            return True
+        for f in files:
+            if not os.path.exists(f):
+                raise IOError("%s is not found, snapshot can not be checked against it"%f)
+        if not source:
+            return False
+        # same size and mtime, skip the checksum
+        if source.get("stamps") == _file_stamps(files):
+            return True
+        return source.get("md5") == self._source_info()["md5"]
+
+    def _open_snapshot(self, snapshot):
+        """ load taxonomy from a compiled snapshot by mmap
+        :param snapshot: snapshot file
+        :return:         True if loaded, False if it is missing, broken or stale
+        """
+        if not os.path.exists(snapshot):
+            return False
+        try:
+            ret = read_snapshot(snapshot)
+        except Exception as e:
+            print "Cannot read taxonomy snapshot %s: %s"%(snapshot, e)
+            return False
+        if ret is None:
+            print "Taxonomy snapshot %s has an old format, will be rebuilt"%snapshot
+            return False
+        meta, sections = ret
+        if not self._is_snapshot_fresh(meta.get("source")):
+            print "Taxonomy snapshot %s is stale, will be rebuilt"%snapshot
+            return False
+
+        self._parent = sections["parent"]
+        self._rank = sections["rank"]
+        self._name_offset = sections["name_offset"]
+        self._names = sections["names"]
+        self._rank_names = [None] + [str(rank) for rank in meta["rank_names"][1:]]
+        self._source = meta.get("source")
+
+        if "merged_old" in sections:
+            self._merged_old = sections["merged_old"]
+            self._merged_new = sections["merged_new"]
+
+        # optional derived indexes
+        if "lca_keys" in sections and "subtree_end" in sections:
+            self._preorder = sections["preorder"]
+            self._order = sections["order"]
+            self._lca_keys = sections["lca_keys"]
+            self._lca_prefix = sections["lca_prefix"]
+            self._lca_suffix = sections["lca_suffix"]
+            self._lca_table = sections["lca_table"]
+            self._lca_bits = meta["lca_bits"]
+            self._subtree_end = sections["subtree_end"]
+        if "lineage" in sections:
+            self._lineage = sections["lineage"]
+            self.lineage_ranks = [str(rank) for rank in meta["lineage_ranks"]]
+            self.lineage_fallbacks = dict((str(rank), [str(f) for f in fallbacks])
+                                          for rank, fallbacks in meta["lineage_fallbacks"].iteritems())
+        if "name_index" in sections:
+            self._name_index = sections["name_index"]
+            self._name_index_offset = sections["name_index_offset"]
+            self._name_index_taxid = sections["name_index_taxid"]
+            self._name_index_scientific = sections["name_index_scientific"]
+            self.name_synonyms = meta["name_synonyms"]
+        return True
+
+    def compile(self, snapshot):
+        """ write the loaded taxonomy into a binary snapshot, which can be opened
+            by TaxIds(snapshot=snapshot) in a fraction of a second
+        :param snapshot: output snapshot file
+        :return:         None
         """
-        :param dir: tmp directory to put downloaded taxdmp.zip, and unzipped folder
-        :return: taxid_dict
+        self._require_names()
+        sections = OrderedDict()
+        sections["parent"] = self._parent
+        sections["rank"] = self._rank
+        sections["name_offset"] = self._name_offset
+        sections["names"] = self._names
+        meta = {"rank_names": self._rank_names,
+                "source": self._source_info()}
+        if self._merged_old is not None:
+            sections["merged_old"] = self._merged_old
+            sections["merged_new"] = self._merged_new
+        if self._lca_keys is not None:
+            sections["preorder"] = self._preorder
+            sections["order"] = self._order
+            sections["lca_keys"] = self._lca_keys
+            sections["lca_prefix"] = self._lca_prefix
+            sections["lca_suffix"] = self._lca_suffix
+            sections["lca_table"] = self._lca_table
+            sections["subtree_end"] = self._subtree_end
+            meta["lca_bits"] = self._lca_bits
+        if self._lineage is not None:
+            sections["lineage"] = self._lineage
+            meta["lineage_ranks"] = self.lineage_ranks
+            meta["lineage_fallbacks"] = self.lineage_fallbacks
+        if self._name_index is not None:
+            sections["name_index"] = self._name_index
+            sections["name_index_offset"] = self._name_index_offset
+            sections["name_index_taxid"] = self._name_index_taxid
+            sections["name_index_scientific"] = self._name_index_scientific
+            meta["name_synonyms"] = self.name_synonyms
+        write_snapshot(snapshot, sections, meta)
+
+    def share(self, name):
+        """ publish the loaded taxonomy, with its built indexes, into POSIX
+            shared memory, processes attach to it read-only by
+            attach_shared_taxonomy(name) and share the same physical pages
+        :param name: name of shared memory segment
+        :return:     path of shared memory segment
         """
-        _taxid_dict = {} # {taxid: [scientificName, parent, rank]}
+        path = shared_snapshot_path(name)
+        self.compile(path)
+        return path
+
+    def update(self, names=None, nodes=None, merged=None, taxdmp=None):
+        """ update the loaded taxonomy to a newer taxdmp release, the taxonomy
+            arrays are replaced, the LCA index is rebuilt only if the tree
+            topology changed, and the lineage table is recomputed only for the
+            subtrees under added, moved and rank changed taxids. Compile the
+            snapshot again afterwards to keep the update.
+        :param names:  new names.dmp file
+        :param nodes:  new nodes.dmp file
+        :param merged: new merged.dmp file
+        :param taxdmp: new taxdmp.zip, used if names and nodes are not given,
+                       downloaded if none is given
+        :return:       TaxonomyUpdate, the changed taxids
+        """
+        new = TaxIds(names=names, nodes=nodes, merged=merged, taxdmp=taxdmp)
+        self._require_names()
+        size = max(len(self._parent), len(new._parent))
+
+        def _pad(a):
+            ret = np.zeros(size, dtype=a.dtype)
+            ret[:len(a)] = a
+            return ret
+
+        old_present = _pad(self._parent != 0) | _pad(self._name_offset[1:] != self._name_offset[:-1])
+        new_present = _pad(new._parent != 0) | _pad(new._name_offset[1:] != new._name_offset[:-1])
+        both = old_present & new_present
+        # rank codes are assigned per load, compare them in codes of new
+        rank_codes = np.array([new._rank_names.index(rank) if rank in new._rank_names else 255
+                               for rank in self._rank_names], dtype=np.uint8)
+
+        report = TaxonomyUpdate()
+        report.added = np.flatnonzero(new_present & ~old_present)
+        removed = np.flatnonzero(old_present & ~new_present)
+        is_merged = np.zeros(len(removed), dtype=bool)
+        if new._merged_old is not None:
+            is_merged = np.in1d(removed, new._merged_old)
+        report.merged = removed[is_merged]
+        report.deleted = removed[~is_merged]
+        report.moved = np.flatnonzero(both & (_pad(self._parent) != _pad(new._parent)))
+        report.reranked = np.flatnonzero(both & (rank_codes[_pad(self._rank)] != _pad(new._rank)))
+        renamed = _changed_names(self._name_offset, self._names, new._name_offset, new._names)
+        report.renamed = renamed[both[renamed]]
+        topology_changed = len(report.added) or len(removed) or len(report.moved)
+
+        # take over the new release
+        self.names, self.nodes, self.merged, self.taxdmp = names, nodes, merged, new.taxdmp
+        self._source = None
+        self._parent, self._rank, self._rank_names = new._parent, new._rank, new._rank_names
+        self._name_offset, self._names = new._name_offset, new._names
+        self._merged_old, self._merged_new = new._merged_old, new._merged_new
+
+        # derived indexes
+        if self._lca_keys is None:
+            report.lca_index = "not built"
+        elif topology_changed:
+            self.build_lca_index()
+            report.lca_index = "rebuilt"
+        else:
+            report.lca_index = "kept"
+        changed = np.concatenate([report.added, report.moved, report.reranked])
+        if self._lca_keys is not None:
+            report.affected = np.flatnonzero(self._get_subtree_mask(changed))
+        else:
+            report.affected = changed
+        if self._lineage is None:
+            report.lineage_table = "not built"
+        elif len(changed) or len(removed):
+            self.build_lineage_table(self.lineage_ranks, self.lineage_fallbacks, taxids=changed)
+            report.lineage_table = "patched for %d taxids"%len(report.affected)
+        else:
+            report.lineage_table = "kept"
+        if self._name_index is None:
+            report.name_index = "not built"
+        elif self.name_synonyms or len(report.added) or len(removed) or len(report.renamed):
+            self.build_name_index(synonyms=self.name_synonyms)
+            report.name_index = "rebuilt"
+        else:
+            report.name_index = "kept"
+        return report
 
+    def _update_taxid_store(self, dir=os.getcwd(), lazy_names=False):
+        """
+        :param dir: directory to put downloaded taxdmp.zip
+        :param lazy_names: if True, only load nodes.dmp, names.dmp is memory
+                           mapped for sciName lookups, see _require_names()
+        :return: None, the compact taxonomy arrays are filled in place
+        """
         # open names and nodes file for read, if given
         if self.names and self.nodes:
             try:
@@ -73,67 +654,213 @@ class TaxIds(object):
                 nodes = open(self.nodes, "r")
             except Exception as e:
                 print "Cannot open names or nodes file for read: %s"%e
-
-        # download taxdmp file, unzip, then open names and nodes file for read
-        else:
-
-            if os.path.exists(os.path.join(dir, "taxdmp.zip")):
-                print "\n\nWARNING: taxdmp.zip exists, will be removed!\n\n"
-                os.system("rm %s"%os.path.join(dir, "taxdmp.zip"))
-
-            # download
-            try:
-                proc = subprocess.Popen(["wget",
-                                               self._taxdmp_ftp, # ftp address for taxdmp
-                                               "-P", dir    # directory to save taxdmp
-                                             ])
-                proc.wait()
-            except Exception as e:
-                print "Cannot download taxdmp file because: %s"%e
-            # unzip
-            try:
-                proc = subprocess.Popen(["unzip",
-                                         "-o",                              # overwrite files without prompting
-                                         "-d", os.path.join(dir, "taxdmp"),  # extract files into directory
-                                         os.path.join(dir, "taxdmp.zip")])
-                proc.wait()
-            except Exception as e:
-                print "Error raised in unzipping taxdmp.zip file: %s"%e
-            # read
+                raise
             try:
-                names = open(os.path.join(dir, "taxdmp", "names.dmp"), "r")
-                nodes = open(os.path.join(dir, "taxdmp", "nodes.dmp"), "r")
-            except Exception as e:
-                print "Cannot open names or nodes file for read: %s"%e
+                if lazy_names:
+                    self._load_nodes(nodes)
+                    self._lazy_names = _LazyNames(self.names)
+                else:
+                    self._load_dmp(names, nodes)
+            finally:
+                names.close()
+                nodes.close()
+            if self.merged:
+                with open(self.merged, "r") as merged:
+                    self._load_merged(merged)
+            return
+
+        # download taxdmp.zip, if no local one is given
+        if not self.taxdmp:
+            if not self.download:
+                raise IOError("names and nodes or taxdmp.zip are needed to build taxonomy")
+            self.taxdmp = self._download_taxdmp(dir)
+
+        # stream names.dmp and nodes.dmp out of the zip archive
+        try:
+            taxdmp = zipfile.ZipFile(self.taxdmp, "r")
+        except Exception as e:
+            print "Cannot open %s for read: %s"%(self.taxdmp, e)
+            raise
+        try:
+            self._load_dmp(_iter_zip_lines(taxdmp, "names.dmp"), _iter_zip_lines(taxdmp, "nodes.dmp"))
+            if "merged.dmp" in taxdmp.namelist():
+                self._load_merged(_iter_zip_lines(taxdmp, "merged.dmp"))
+        finally:
+            taxdmp.close()
+
+    def _download_taxdmp(self, dir):
+        """ download taxdmp.zip into dir, an existing archive is only
+            downloaded again if the one on NCBI ftp is newer
+        :param dir: directory to put downloaded taxdmp.zip
+        :return:    path of taxdmp.zip
+        """
+        taxdmp = os.path.join(dir, "taxdmp.zip")
+        stamps = _file_stamps([taxdmp]) if os.path.exists(taxdmp) else None
+        try:
+            proc = subprocess.Popen(["wget",
+                                     "-N",               # only download if newer than local file
+                                     self._taxdmp_ftp,   # ftp address for taxdmp
+                                     "-P", dir           # directory to save taxdmp
+                                     ])
+            proc.wait()
+        except Exception as e:
+            print "Cannot download taxdmp file because: %s"%e
+        if not os.path.exists(taxdmp):
+            raise IOError("taxdmp.zip is not available in %s"%dir)
+        if stamps and stamps == _file_stamps([taxdmp]):
+            print "taxdmp.zip in %s is up to date, not downloaded again"%dir
+        return taxdmp
+
+    def _load_dmp(self, names, nodes):
+        """ parse opened names.dmp and nodes.dmp into the compact arrays
+        :param names: opened names.dmp file
+        :param nodes: opened nodes.dmp file
+        """
+        self._load_nodes(nodes)
+        self._load_names(names)
 
-        # read names.dmp,
+    def _load_nodes(self, nodes):
+        """ parse opened nodes.dmp into parent pointers and rank codes
+        :param nodes: opened nodes.dmp file
+        """
+        # read nodes.dmp, rank strings are encoded as small integers
+        node_taxids = array("i")
+        node_parents = array("i")
+        node_ranks = array("B")
+        rank_codes = {}
+        for line in nodes:
+            if line.startswith("\n"):
+                continue
+            line = line.rstrip("\t|\n").split("\t|\t")
+            node_taxids.append(int(line[0]))
+            node_parents.append(int(line[1]))
+            rank = line[2]
+            if rank not in rank_codes:
+                rank_codes[rank] = len(self._rank_names)
+                self._rank_names.append(rank)
+            node_ranks.append(rank_codes[rank])
+
+        node_taxids = np.frombuffer(node_taxids, dtype=np.intc) if node_taxids else np.zeros(0, np.intc)
+        max_taxid = int(node_taxids.max()) if len(node_taxids) else 0
+
+        # parent pointers and rank codes, as dense arrays indexed by taxid
+        self._parent = np.zeros(max_taxid+1, dtype=np.int32)
+        self._rank = np.zeros(max_taxid+1, dtype=np.uint8)
+        if len(node_taxids):
+            self._parent[node_taxids] = np.frombuffer(node_parents, dtype=np.intc)
+            self._rank[node_taxids] = np.frombuffer(node_ranks, dtype=np.uint8)
+
+    def _load_names(self, names):
+        """ parse opened names.dmp into the concatenated scientific names,
+            after _load_nodes()
+        :param names: opened names.dmp file
+        """
+        # read names.dmp, keep only scientific names
+        name_taxids = array("i")
+        name_list = []
         for line in names:
             if line.startswith("\n"):
                 continue
             line = line.rstrip("\t|\n").split("\t|\t")
             if line[3] == "scientific name":
-                # first get taxid:[scitificname]
-                _taxid_dict.update({int(line[0]):[line[1]]})
-
-        for line in nodes:
+                name_taxids.append(int(line[0]))
+                name_list.append(line[1])
+
+        name_taxids = np.frombuffer(name_taxids, dtype=np.intc) if name_taxids else np.zeros(0, np.intc)
+        max_taxid = max([len(self._parent)-1] + ([int(name_taxids.max())] if len(name_taxids) else []))
+
+        # taxids only in names.dmp
+        if max_taxid >= len(self._parent):
+            parent = np.zeros(max_taxid+1, dtype=np.int32)
+            parent[:len(self._parent)] = self._parent
+            rank = np.zeros(max_taxid+1, dtype=np.uint8)
+            rank[:len(self._rank)] = self._rank
+            self._parent, self._rank = parent, rank
+
+        # names sorted by taxid, then concatenated, the last one wins if a
+        # taxid has more than one scientific name
+        order = np.argsort(name_taxids, kind="mergesort")
+        sorted_taxids = name_taxids[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[:-1] = sorted_taxids[:-1] != sorted_taxids[1:]
+        order = order[keep]
+        name_lengths = np.zeros(max_taxid+1, dtype=np.int64)
+        name_lengths[sorted_taxids[keep]] = [len(name_list[i]) for i in order]
+        name_offset = np.zeros(max_taxid+2, dtype=np.int64)
+        np.cumsum(name_lengths, out=name_offset[1:])
+        if name_offset[-1] < 2**32:
+            name_offset = name_offset.astype(np.uint32)
+        self._name_offset = name_offset
+        self._names = "".join([name_list[i] for i in order])
+
+    def _require_names(self):
+        """ load all scientific names, if they were left to lazy lookups
+        """
+        if self._lazy_names is None:
+            return
+        with open(self.names, "r") as names:
+            self._load_names(names)
+        self._lazy_names.close()
+        self._lazy_names = None
+
+    def _load_merged(self, merged):
+        """ parse opened merged.dmp, lines look like:
+
+            old_taxid    |    new_taxid    |
+        :param merged: opened merged.dmp file
+        """
+        old_taxids = array("i")
+        new_taxids = array("i")
+        for line in merged:
             if line.startswith("\n"):
                 continue
             line = line.rstrip("\t|\n").split("\t|\t")
-            taxid = int(line[0])
-            parent = int(line[1])
-            rank = line[2]
-            if taxid in _taxid_dict:
-                _taxid_dict[taxid].append(parent)
-                _taxid_dict[taxid].append(rank)
-            else:
-                _taxid_dict.update({taxid:["None", parent, rank]})
-
-        if not names.closed:
-            names.close()
-        if not nodes.closed:
-            nodes.close()
-
-        return _taxid_dict
+            old_taxids.append(int(line[0]))
+            new_taxids.append(int(line[1]))
+        old_taxids = np.array(old_taxids, dtype=np.int32)
+        new_taxids = np.array(new_taxids, dtype=np.int32)
+        order = np.argsort(old_taxids, kind="mergesort")
+        self._merged_old = old_taxids[order]
+        self._merged_new = new_taxids[order]
+
+    def resolve_taxid(self, taxid):
+        """ given a taxid, return the taxid it was merged into, according to
+            merged.dmp, or itself if it was not merged
+        :param taxid: input query taxid
+        :return:      current taxid
+        """
+        taxid = _as_taxid(taxid)
+        if taxid is None or self._merged_old is None or not len(self._merged_old):
+            return taxid
+        i = int(np.searchsorted(self._merged_old, taxid))
+        if i < len(self._merged_old) and self._merged_old[i] == taxid:
+            return int(self._merged_new[i])
+        return taxid
+
+    def _resolve_batch(self, taxids):
+        """ vectorized resolve_taxid() over a numpy array of taxids
+        """
+        if self._merged_old is None or not len(self._merged_old) or not len(taxids):
+            return taxids
+        i = np.searchsorted(self._merged_old, taxids)
+        i[i == len(self._merged_old)] = 0
+        merged = self._merged_old[i] == taxids
+        if not merged.any():
+            return taxids
+        taxids = taxids.copy()
+        taxids[merged] = self._merged_new[i[merged]]
+        return taxids
+
+    def _has_taxid(self, taxid):
+        """ check whether taxid is present in names.dmp or nodes.dmp
+        """
+        if 0 < taxid < len(self._parent):
+            if self._parent[taxid]:
+                return True
+            if self._lazy_names is not None:
+                return self._lazy_names.get(taxid) is not None
+            return self._name_offset[taxid] != self._name_offset[taxid+1]
+        return False
 
     def get_parent(self, taxid):
         """ given a taxid, return its parent's taxid
@@ -143,14 +870,18 @@ class TaxIds(object):
         if not taxid:
             return None
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+        taxid = _as_taxid(taxid)
 
-        if self.container.has_key(taxid):
-            return self.container[taxid][1]
+        if taxid is not None and 0 < taxid < len(self._parent):
+            parent = int(self._parent[taxid])
+            if parent:
+                return parent
+
+        # look up the taxid it was merged into
+        if self._merged_old is not None:
+            new_taxid = self.resolve_taxid(taxid)
+            if new_taxid != taxid:
+                return self.get_parent(new_taxid)
 
     def get_sciName(self, taxid):
         """ given a taxid, return its scientific name
@@ -160,14 +891,22 @@ class TaxIds(object):
         if taxid is None:
             return None
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+        taxid = _as_taxid(taxid)
 
-        if self.container.has_key(taxid):
-            return self.container[taxid][0]
+        if taxid is not None and self._has_taxid(taxid):
+            if self._lazy_names is not None:
+                name = self._lazy_names.get(taxid)
+                return "None" if name is None else name
+            start, end = self._name_offset[taxid], self._name_offset[taxid+1]
+            if start == end:
+                return "None"
+            return self._names[start:end]
+
+        # look up the taxid it was merged into
+        if self._merged_old is not None:
+            new_taxid = self.resolve_taxid(taxid)
+            if new_taxid != taxid:
+                return self.get_sciName(new_taxid)
 
     def get_rank(self, taxid):
         """ given a taxid, return its rank info
@@ -177,14 +916,10 @@ class TaxIds(object):
         if not taxid:
             return None
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+        taxid = self.resolve_taxid(taxid)
 
-        if self.container.has_key(taxid):
-            return self.container[taxid][2]
+        if taxid is not None and 0 < taxid < len(self._rank):
+            return self._rank_names[self._rank[taxid]]
 
     def get_path(self, taxid, toStr=False):
         """ given a taxid, return its path from root to this node
@@ -195,11 +930,7 @@ class TaxIds(object):
         if not taxid:
             return None
 
-        if not type(taxid) == int:
-            try:
-                taxid = int(str(taxid).strip())
-            except Exception as e:
-                print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+        taxid = self.resolve_taxid(taxid)
 
         _path = []
         _path.append(taxid)
@@ -230,11 +961,7 @@ class TaxIds(object):
         # assume only one meet the query_rank in one Taxid_Path
         ret = False
         for taxid in Taxid_Path:
-            if not type(taxid) == int:
-                try:
-                    taxid = int(str(taxid).strip())
-                except Exception as e:
-                    print "taxid %s cannot converted to integer: %s !!"%(taxid, e)
+            taxid = _as_taxid(taxid)
             _rank = self.get_rank(taxid)
             if _rank == query_rank:
                 ret = True
@@ -282,6 +1009,642 @@ class TaxIds(object):
             _path1 = self.get_path(taxid1)
             return _path1.pop()
 
+    def build_lca_index(self):
+        """ precompute the LCA index of the taxonomy tree under root 1:
+
+            1) number the nodes in pre-order, children in increasing taxid
+            2) key each pre-order position by (depth << _lca_bits | position)
+            3) split the keys into blocks of _LCA_BLOCK, store prefix and suffix
+               minimum inside each block, and a sparse table over block minimum
+
+            for two nodes u, v with preorder[u] < preorder[v], the node with
+            minimum key in pre-order range (preorder[u], preorder[v]] is a child of
+            their LCA, and the range minimum is answered in constant time from
+            the tables above, with O(n) memory.
+
+            the subtree of a node also takes a contiguous pre-order range,
+            from its own position to _subtree_end, so clade membership is
+            tested in constant time, see is_in_clade().
+        :return: None
+        """
+        parent = self._parent
+        max_taxid = len(parent) - 1
+
+        # nodes level by level from root, nodes not tracing back to root 1 are
+        # left out of the index
+        candidates = np.flatnonzero(parent)
+        candidates = candidates[candidates != parent[candidates]]
+        in_tree = np.zeros(max_taxid+1, dtype=bool)
+        levels = []
+        if max_taxid >= 1:
+            in_tree[1] = True
+            levels.append(np.array([1]))
+            frontier = np.zeros(max_taxid+1, dtype=bool)
+            frontier[1] = True
+            while len(candidates):
+                hit = frontier[parent[candidates]]
+                level = candidates[hit]
+                if not len(level):
+                    break
+                candidates = candidates[~hit]
+                frontier[:] = False
+                frontier[level] = True
+                in_tree[level] = True
+                levels.append(level)
+
+        # subtree size, bottom up
+        size = np.ones(max_taxid+1, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            np.add.at(size, parent[level], size[level])
+
+        # pre-order position, top down, a child starts right after its parent
+        # plus the subtrees of its smaller siblings
+        preorder = np.full(max_taxid+1, -1, dtype=np.int32)
+        depth = np.zeros(max_taxid+1, dtype=np.int32)
+        if levels:
+            preorder[1] = 0
+        for d, level in enumerate(levels[1:], 1):
+            level = level[np.lexsort((level, parent[level]))]
+            parents = parent[level]
+            sizes = size[level]
+            before = np.cumsum(sizes) - sizes
+            group_start = np.ones(len(level), dtype=bool)
+            group_start[1:] = parents[1:] != parents[:-1]
+            start_index = np.maximum.accumulate(np.where(group_start, np.arange(len(level)), 0))
+            preorder[level] = preorder[parents] + 1 + before - before[start_index]
+            depth[level] = d
+
+        nodes = np.flatnonzero(in_tree)
+        n = len(nodes)
+        order = np.zeros(n, dtype=np.int32)
+        order[preorder[nodes]] = nodes
+        subtree_end = (np.arange(n) + size[order]).astype(np.int32)
+
+        # keys of pre-order positions, compared by depth first
+        bits = max(1, int(n).bit_length())
+        max_depth = len(levels)
+        key_type = np.int32 if (max_depth+1) << bits < 2**31 else np.int64
+        keys = (depth[order].astype(key_type) << bits) | np.arange(n, dtype=key_type)
+
+        # block prefix/suffix minimum and sparse table over block minimum
+        block = _LCA_BLOCK
+        n_blocks = max(1, (n + block - 1) // block)
+        padded = np.full(n_blocks*block, np.iinfo(key_type).max, dtype=key_type)
+        padded[:n] = keys
+        padded = padded.reshape(n_blocks, block)
+        prefix = np.minimum.accumulate(padded, axis=1).ravel()[:n]
+        suffix = np.minimum.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()[:n]
+        table = [padded.min(axis=1)]
+        width = 1
+        while 2*width <= n_blocks:
+            last = table[-1]
+            level = last.copy()
+            level[:n_blocks-width] = np.minimum(last[:n_blocks-width], last[width:])
+            table.append(level)
+            width *= 2
+
+        self._preorder = preorder
+        self._order = order
+        self._lca_keys = keys
+        self._lca_bits = bits
+        self._lca_prefix = np.ascontiguousarray(prefix)
+        self._lca_suffix = np.ascontiguousarray(suffix)
+        self._lca_table = np.vstack(table)
+        self._subtree_end = subtree_end
+
+    def _lca_range_min(self, left, right):
+        """ minimum of _lca_keys in pre-order range [left, right]
+        """
+        left_block = left // _LCA_BLOCK
+        right_block = right // _LCA_BLOCK
+        if left_block == right_block:
+            return self._lca_keys[left:right+1].min()
+        ret = min(self._lca_suffix[left], self._lca_prefix[right])
+        if right_block - left_block > 1:
+            left_block += 1
+            right_block -= 1
+            k = (right_block - left_block + 1).bit_length() - 1
+            ret = min(ret, self._lca_table[k, left_block],
+                      self._lca_table[k, right_block - (1 << k) + 1])
+        return ret
+
+    def _get_lca_by_index(self, ListOfTaxid):
+        """ LCA of a list of taxid from the LCA index, the LCA of many nodes is
+            the LCA of the two nodes with smallest and largest pre-order
+        :param ListOfTaxid: list of integer taxid
+        :return:            the LCA taxid, None if any taxid is not in index
+        """
+        preorder = self._preorder
+        max_taxid = len(preorder) - 1
+        positions = []
+        for taxid in ListOfTaxid:
+            if not 0 < taxid <= max_taxid:
+                return None
+            position = int(preorder[taxid])
+            if position < 0:
+                return None
+            positions.append(position)
+        left, right = min(positions), max(positions)
+        if left == right:
+            return int(self._order[left])
+        key = self._lca_range_min(left+1, right)
+        child = self._order[int(key) & ((1 << self._lca_bits) - 1)]
+        return int(self._parent[child])
+
+    def _get_positions(self, taxids):
+        """ pre-order positions of an array of taxids, -1 if not in LCA index
+        """
+        if self._lca_keys is None:
+            self.build_lca_index()
+        taxids = self._resolve_batch(np.asarray(taxids, dtype=np.int64))
+        valid = (taxids > 0) & (taxids < len(self._preorder))
+        positions = np.full(len(taxids), -1, dtype=np.int64)
+        positions[valid] = self._preorder[taxids[valid]]
+        return positions
+
+    def _lca_range_min_batch(self, left, right):
+        """ vectorized _lca_range_min() over arrays of pre-order ranges
+        """
+        keys = self._lca_keys
+        ret = np.empty(len(left), dtype=keys.dtype)
+        left_block = left // _LCA_BLOCK
+        right_block = right // _LCA_BLOCK
+
+        # ranges inside one block, scan the block
+        same = np.flatnonzero(left_block == right_block)
+        if len(same):
+            _left, _right = left[same], right[same]
+            _min = keys[_left]
+            for i in range(1, _LCA_BLOCK):
+                inside = np.flatnonzero(_left + i <= _right)
+                if not len(inside):
+                    break
+                _min[inside] = np.minimum(_min[inside], keys[_left[inside] + i])
+            ret[same] = _min
+
+        # ranges across blocks, block suffix + sparse table + block prefix
+        cross = np.flatnonzero(left_block != right_block)
+        if len(cross):
+            _min = np.minimum(self._lca_suffix[left[cross]], self._lca_prefix[right[cross]])
+            first = left_block[cross] + 1
+            last = right_block[cross] - 1
+            inner = np.flatnonzero(last >= first)
+            if len(inner):
+                first, last = first[inner], last[inner]
+                k = np.frexp(last - first + 1)[1] - 1
+                _min[inner] = np.minimum(_min[inner],
+                                         np.minimum(self._lca_table[k, first],
+                                                    self._lca_table[k, last - (1 << k) + 1]))
+            ret[cross] = _min
+        return ret
+
+    def get_lca_batch(self, taxids, offsets):
+        """ LCA of many groups of taxids in one call, taxids of group i are
+            taxids[offsets[i]:offsets[i+1]]
+        :param taxids:  numpy array of taxids of all groups
+        :param offsets: numpy array of group boundaries, len(offsets) = groups + 1
+        :return:        (lca, rank, depth) numpy arrays, one item per group,
+                        empty group gives lca 0, rank None and depth -1
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n_groups = len(offsets) - 1
+        lca = np.zeros(n_groups, dtype=np.int64)
+
+        filled = np.flatnonzero(offsets[1:] > offsets[:-1])
+        if len(filled) and len(taxids):
+            positions = self._get_positions(taxids)
+            starts = offsets[filled]
+            left = np.minimum.reduceat(positions, starts)
+            right = np.maximum.reduceat(positions, starts)
+
+            # groups with taxid outside LCA index go through get_lca()
+            fallback = left < 0
+            for i in np.flatnonzero(fallback):
+                group = filled[i]
+                lca[group] = self.get_lca(taxids[offsets[group]:offsets[group+1]].tolist())
+
+            single = np.flatnonzero(~fallback & (left == right))
+            lca[filled[single]] = self._order[left[single]]
+
+            multiple = np.flatnonzero(~fallback & (left < right))
+            if len(multiple):
+                keys = self._lca_range_min_batch(left[multiple] + 1, right[multiple])
+                children = self._order[keys & ((1 << self._lca_bits) - 1)]
+                lca[filled[multiple]] = self._parent[children]
+
+        return lca, self.get_rank_batch(lca), self.get_depth_batch(lca)
+
+    def get_rank_batch(self, taxids):
+        """ ranks of an array of taxids
+        :param taxids: numpy array of taxids
+        :return:       numpy object array of rank, None if not found
+        """
+        taxids = self._resolve_batch(np.asarray(taxids, dtype=np.int64))
+        valid = (taxids > 0) & (taxids < len(self._rank))
+        codes = np.zeros(len(taxids), dtype=np.uint8)
+        codes[valid] = self._rank[taxids[valid]]
+        return np.array(self._rank_names, dtype=object)[codes]
+
+    def get_sciName_batch(self, taxids):
+        """ scientific names of an array of taxids, each distinct taxid is
+            looked up once
+        :param taxids: numpy array of taxids
+        :return:       numpy object array of name, None if not found
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        unique, inverse = np.unique(taxids, return_inverse=True)
+        names = np.empty(len(unique), dtype=object)
+        names[:] = [self.get_sciName(taxid) for taxid in unique.tolist()]
+        return names[inverse]
+
+    def _get_parent_batch(self, taxids):
+        """ vectorized get_parent() over a numpy array of taxids, 0 if none
+        """
+        parents = np.zeros(len(taxids), dtype=np.int64)
+        valid = (taxids > 0) & (taxids < len(self._parent))
+        parents[valid] = self._parent[taxids[valid]]
+        # look up the taxid it was merged into
+        missing = np.flatnonzero(parents == 0)
+        if len(missing):
+            resolved = self._resolve_batch(taxids[missing])
+            merged = resolved != taxids[missing]
+            if merged.any():
+                parents[missing[merged]] = self._get_parent_batch(resolved[merged])
+        return parents
+
+    def get_path_batch(self, taxids):
+        """ paths from root of an array of taxids, all paths are walked up
+            the parent array one level at a time
+        :param taxids: numpy array of taxids
+        :return:       list of paths as get_path(), None for taxid 0
+        """
+        taxids = self._resolve_batch(np.asarray(taxids, dtype=np.int64))
+        levels = [taxids]
+        active = taxids != 0
+        while active.any():
+            parents = np.zeros(len(taxids), dtype=np.int64)
+            parents[active] = self._get_parent_batch(levels[-1][active])
+            levels.append(parents)
+            active &= (parents != 0) & (parents != 1)
+
+        # a path ends at its first 0, taxids of all paths are reversed at
+        # once to go from root to leaves, the last path comes first then
+        levels = np.column_stack(levels)
+        present = levels != 0
+        lengths = present.sum(axis=1)
+        taxids = levels[present][::-1].tolist()
+        starts = len(taxids) - np.cumsum(lengths)
+        return [taxids[start:start+length] if length else None
+                for start, length in zip(starts.tolist(), lengths.tolist())]
+
+    def get_depth_batch(self, taxids):
+        """ depths of an array of taxids, root 1 has depth 0
+        :param taxids: numpy array of taxids
+        :return:       numpy array of depth, -1 if not in LCA index
+        """
+        positions = self._get_positions(taxids)
+        depth = np.full(len(positions), -1, dtype=np.int64)
+        valid = positions >= 0
+        depth[valid] = self._lca_keys[positions[valid]] >> self._lca_bits
+        return depth
+
+    def is_in_clade(self, taxid, clade):
+        """ given a taxid, check whether it is in the clade under another
+            taxid, i.e. it is the clade taxid or one of its descendants, in
+            constant time from the pre-order numbering of LCA index
+        :param taxid: input query taxid
+        :param clade: taxid of the clade
+        :return:      True or False
+        """
+        if self._lca_keys is None:
+            self.build_lca_index()
+        position, clade_position = self._get_positions([taxid, clade]).tolist()
+        if position < 0 or clade_position < 0:
+            return False
+        return clade_position <= position < self._subtree_end[clade_position]
+
+    def in_clades_batch(self, taxids, clades):
+        """ vectorized is_in_clade() of an array of taxids, against any of
+            several clades
+        :param taxids: numpy array of taxids
+        :param clades: list or numpy array of clade taxids
+        :return:       numpy bool array, True if the taxid is in any clade
+        """
+        positions = self._get_positions(taxids)
+        starts = self._get_positions(clades)
+        starts = np.unique(starts[starts >= 0])
+        if not len(starts):
+            return np.zeros(len(positions), dtype=bool)
+
+        # clades are nested or disjoint, drop the ones inside another
+        ends = self._subtree_end[starts].astype(np.int64)
+        covered = np.append(-1, np.maximum.accumulate(ends)[:-1])
+        starts, ends = starts[starts >= covered], ends[starts >= covered]
+
+        i = np.searchsorted(starts, positions, side="right") - 1
+        return (i >= 0) & (positions >= 0) & (positions < ends[np.maximum(i, 0)])
+
+    def filter_clades_batch(self, taxids, include=None, exclude=None):
+        """ select taxids in any of include clades, and not in any of
+            exclude clades
+        :param taxids:  numpy array of taxids
+        :param include: list of clade taxids to keep, all taxids if None
+        :param exclude: list of clade taxids to drop, none if None
+        :return:        numpy bool array, True for taxids kept
+        """
+        keep = np.ones(len(taxids), dtype=bool)
+        if include:
+            keep &= self.in_clades_batch(taxids, include)
+        if exclude:
+            keep &= ~self.in_clades_batch(taxids, exclude)
+        return keep
+
+    def _get_levels(self):
+        """ nodes of the LCA index grouped by depth
+        :return: list of taxid arrays, the i-th holds nodes of depth i
+        """
+        if self._lca_keys is None:
+            self.build_lca_index()
+        depth = self._lca_keys >> self._lca_bits
+        by_depth = np.argsort(depth, kind="mergesort")
+        level_start = np.searchsorted(depth[by_depth], np.arange(int(depth.max())+2))
+        return [self._order[by_depth[level_start[d]:level_start[d+1]]]
+                for d in range(len(level_start)-1)]
+
+    def _get_subtree_mask(self, taxids, levels=None):
+        """ mark taxids and all their descendants
+        :param taxids: numpy array of taxids
+        :param levels: result of _get_levels(), if already at hand
+        :return:       numpy bool array indexed by taxid
+        """
+        if levels is None:
+            levels = self._get_levels()
+        taxids = np.asarray(taxids, dtype=np.int64)
+        subtree = np.zeros(len(self._parent), dtype=bool)
+        subtree[taxids[(taxids > 0) & (taxids < len(subtree))]] = True
+        for nodes in levels[1:]:
+            subtree[nodes] |= subtree[self._parent[nodes]]
+        return subtree
+
+    def get_clade_counts(self, taxids, counts=None):
+        """ count assignments to each taxid, then add the counts of each node
+            to its parent once, from the deepest level up to root
+        :param taxids: numpy array of assigned taxids, e.g. the LCA of each read
+        :param counts: numpy array of counts of each taxid, 1 if not given
+        :return:       (direct, clade) numpy arrays indexed by taxid, counts
+                       assigned to a taxid, and to the clade under a taxid
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        valid = (taxids > 0) & (taxids < len(self._parent))
+        weights = None if counts is None else np.asarray(counts)[valid]
+        direct = np.bincount(taxids[valid], weights=weights, minlength=len(self._parent))
+        direct = direct.astype(np.int64)
+
+        clade = direct.copy()
+        for nodes in reversed(self._get_levels()[1:]):
+            np.add.at(clade, self._parent[nodes], clade[nodes])
+        return direct, clade
+
+    def write_abundance_report(self, oh, taxids, counts=None):
+        """ write a kraken style report of clade counts, one line per taxon
+            with assignments in its clade, in pre-order of taxonomy tree:
+
+            percentage  clade_count  direct_count  rank_code  taxid  indented_sciName
+
+            percentage is relative to all assignments under root
+        :param oh:     opened output file
+        :param taxids: numpy array of assigned taxids, e.g. the LCA of each read
+        :param counts: numpy array of counts of each taxid, 1 if not given
+        :return:       None
+        """
+        direct, clade = self.get_clade_counts(taxids, counts)
+        nodes = np.flatnonzero((clade > 0) & (self._preorder >= 0)) if len(clade) else np.zeros(0, int)
+        nodes = nodes[np.argsort(self._preorder[nodes])]
+        total = clade[1] if len(clade) > 1 else 0
+        for taxid, depth in zip(nodes, self.get_depth_batch(nodes)):
+            taxid = int(taxid)
+            if taxid == 1:
+                rank_code = "R"
+            else:
+                rank_code = REPORT_RANK_CODES.get(self.get_rank(taxid), "-")
+            oh.write("%6.2f\t%d\t%d\t%s\t%d\t%s%s\n"%(100.0*clade[taxid]/total, clade[taxid],
+                     direct[taxid], rank_code, taxid, "  "*depth, self.get_sciName(taxid)))
+
+    def build_lineage_table(self, ranks=LINEAGE_RANKS, fallbacks=LINEAGE_FALLBACKS, taxids=None):
+        """ precompute the ancestor of every taxid at each of ranks, a taxid
+            gets the topmost ancestor of a rank on its path, same as
+            get_query_rank_from_path(), if no ancestor has the rank, the
+            ancestor at its fallback ranks is used instead.
+        :param ranks:     list of ranks, the rows of lineage table
+        :param fallbacks: {rank: [fallback rank, ...]}
+        :param taxids:    numpy array of taxids whose whole subtrees are
+                          recomputed in the existing table of the same ranks,
+                          all taxids are computed if not given
+        :return:          None
+        """
+        if self._lca_keys is None:
+            self.build_lca_index()
+
+        all_ranks = list(ranks)
+        for rank in ranks:
+            for fallback in fallbacks.get(rank, []):
+                if fallback not in all_ranks:
+                    all_ranks.append(fallback)
+        codes = np.array([self._rank_names.index(rank) if rank in self._rank_names else -1
+                          for rank in all_ranks])
+
+        levels = self._get_levels()
+        table = np.zeros((len(all_ranks), len(self._parent)), dtype=np.int32)
+        if taxids is None:
+            columns = slice(None)
+        else:
+            # only the subtrees under taxids, each subtree starts from the
+            # ancestors of its parent, read off the path of its parent
+            subtree = self._get_subtree_mask(taxids, levels)
+            for d in range(1, len(levels)):
+                nodes = levels[d]
+                top = nodes[subtree[nodes] & ~subtree[self._parent[nodes]]]
+                for parent in np.unique(self._parent[top]):
+                    path = np.array(self.get_path(int(parent)))
+                    path_ranks = self._rank[path]
+                    for i, code in enumerate(codes):
+                        found = np.flatnonzero(path_ranks == code)
+                        if len(found):
+                            table[i, parent] = path[found[0]]
+                levels[d] = nodes[subtree[nodes]]
+            levels[0] = levels[0][subtree[levels[0]]]
+            columns = np.flatnonzero(subtree)
+
+        # walk down the tree level by level, inherit the lineage of parent,
+        # then fill in ranks not found above
+        for d, nodes in enumerate(levels):
+            if d > 0:
+                table[:, nodes] = table[:, self._parent[nodes]]
+            node_ranks = self._rank[nodes]
+            for i, code in enumerate(codes):
+                own = (node_ranks == code) & (table[i, nodes] == 0)
+                table[i, nodes[own]] = nodes[own]
+
+        if taxids is None:
+            lineage = np.zeros((len(ranks), len(self._parent)), dtype=np.int32)
+        else:
+            # existing table may be read-only in snapshot, or have less taxids
+            old = self._lineage
+            lineage = np.zeros((len(ranks), len(self._parent)), dtype=np.int32)
+            width = min(old.shape[1], lineage.shape[1])
+            lineage[:, :width] = old[:, :width]
+            lineage[:, self._preorder < 0] = 0
+        for i, rank in enumerate(ranks):
+            lineage[i, columns] = table[i, columns]
+            for fallback in fallbacks.get(rank, []):
+                missing = np.flatnonzero(lineage[i, columns] == 0)
+                if not isinstance(columns, slice):
+                    missing = columns[missing]
+                lineage[i, missing] = table[all_ranks.index(fallback), missing]
+
+        self._lineage = lineage
+        self.lineage_ranks = list(ranks)
+        self.lineage_fallbacks = dict((rank, list(fallbacks[rank])) for rank in ranks
+                                      if rank in fallbacks)
+
+    def get_lineage(self, taxid, toStr=False):
+        """ given a taxid, return its ancestors at lineage_ranks
+        :param taxid: input query taxid
+        :param toStr: if True, return scientific names, else return taxids
+        :return:      list of ancestors, None for missing ranks
+        """
+        if self._lineage is None:
+            self.build_lineage_table()
+        taxid = self.resolve_taxid(taxid)
+        if taxid is None or not 0 < taxid < self._lineage.shape[1]:
+            return [None]*len(self.lineage_ranks)
+        ret = [int(ancestor) or None for ancestor in self._lineage[:, taxid]]
+        if toStr:
+            return [self.get_sciName(ancestor) for ancestor in ret]
+        return ret
+
+    def get_lineage_batch(self, taxids):
+        """ ancestors at lineage_ranks of an array of taxids
+        :param taxids: numpy array of taxids
+        :return:       numpy array of shape (len(taxids), len(lineage_ranks)),
+                       0 for missing ranks
+        """
+        if self._lineage is None:
+            self.build_lineage_table()
+        taxids = self._resolve_batch(np.asarray(taxids, dtype=np.int64))
+        ret = np.zeros((len(taxids), len(self.lineage_ranks)), dtype=np.int32)
+        valid = (taxids > 0) & (taxids < self._lineage.shape[1])
+        ret[valid] = self._lineage[:, taxids[valid]].T
+        return ret
+
+    def _iter_names(self, name_classes):
+        """ read names of given classes from names.dmp, or from taxdmp.zip
+        :param name_classes: list of name classes, e.g. ["synonym"]
+        :return:             generator of (taxid, name)
+        """
+        if self.names:
+            names = open(self.names, "r")
+        elif self.taxdmp:
+            taxdmp = zipfile.ZipFile(self.taxdmp, "r")
+            names = _iter_zip_lines(taxdmp, "names.dmp")
+        else:
+            raise IOError("names.dmp or taxdmp.zip is needed to read names other than scientific names")
+        try:
+            for line in names:
+                if line.startswith("\n"):
+                    continue
+                line = line.rstrip("\t|\n").split("\t|\t")
+                if line[3] in name_classes:
+                    yield int(line[0]), line[1]
+        finally:
+            names.close()
+
+    def build_name_index(self, synonyms=False):
+        """ precompute the index of names for get_taxids() and search_names(),
+            names are sorted case-insensitively, then looked up by binary search
+        :param synonyms: if True, also index names of NAME_INDEX_SYNONYMS classes,
+                         read from names.dmp or taxdmp.zip
+        :return:         None
+        """
+        self._require_names()
+        offset = self._name_offset
+        taxids = np.flatnonzero(offset[1:] != offset[:-1])
+        names = [self._names[start:end] for start, end in zip(offset[taxids].tolist(), offset[taxids+1].tolist())]
+        taxids = taxids.tolist()
+        n_scientific = len(names)
+        if synonyms:
+            for taxid, name in self._iter_names(NAME_INDEX_SYNONYMS):
+                taxids.append(taxid)
+                names.append(name)
+
+        # lower() keeps the length of str, the same offsets work for both cases
+        keys = [name.lower() for name in names]
+        order = sorted(xrange(len(names)), key=keys.__getitem__)
+        del keys
+        lengths = np.array([len(names[i]) for i in order], dtype=np.int64)
+        name_offset = np.zeros(len(order)+1, dtype=np.int64)
+        np.cumsum(lengths, out=name_offset[1:])
+        if name_offset[-1] < 2**32:
+            name_offset = name_offset.astype(np.uint32)
+        order = np.array(order, dtype=np.int64)
+
+        self._name_index = "".join([names[i] for i in order.tolist()])
+        self._name_index_offset = name_offset
+        self._name_index_taxid = np.array(taxids, dtype=np.int32)[order]
+        self._name_index_scientific = (order < n_scientific).astype(np.uint8)
+        self.name_synonyms = bool(synonyms)
+
+    def _find_names(self, query, ignore_case, prefix, synonyms):
+        """ positions in name index of names matching query
+        """
+        if self._name_index is None:
+            self.build_name_index()
+        names, offset = self._name_index, self._name_index_offset
+        keys = _NameKeys(names, offset)
+        key = query.lower()
+        start = bisect_left(keys, key)
+        if prefix:
+            end = bisect_left(keys, key + "\xff", start)
+        else:
+            end = bisect_right(keys, key, start)
+        for i in xrange(start, end):
+            if not (synonyms or self._name_index_scientific[i]):
+                continue
+            if not ignore_case:
+                name = names[offset[i]:offset[i+1]]
+                if not (name.startswith(query) if prefix else name == query):
+                    continue
+            yield i
+
+    def get_taxids(self, name, ignore_case=False, prefix=False, synonyms=True):
+        """ given a name, return the taxids having it, e.g. "Prochlorococcus"
+        :param name:        input query name
+        :param ignore_case: if True, match name case-insensitively
+        :param prefix:      if True, match all names starting with name
+        :param synonyms:    if True, also match synonyms, if they are indexed
+        :return:            sorted list of taxids, empty if not found
+        """
+        return sorted(set(int(self._name_index_taxid[i])
+                          for i in self._find_names(name, ignore_case, prefix, synonyms)))
+
+    def search_names(self, query, ignore_case=True, prefix=True, synonyms=True, limit=None):
+        """ names matching query, e.g. for completion of partial names
+        :param query:       input query name
+        :param ignore_case: if True, match query case-insensitively
+        :param prefix:      if True, match all names starting with query
+        :param synonyms:    if True, also match synonyms, if they are indexed
+        :param limit:       return at most this many names
+        :return:            list of (name, taxid), in case-insensitive order
+        """
+        ret = []
+        offset = self._name_index_offset
+        for i in self._find_names(query, ignore_case, prefix, synonyms):
+            if limit is not None and len(ret) >= limit:
+                break
+            ret.append((self._name_index[offset[i]:offset[i+1]], int(self._name_index_taxid[i])))
+        return ret
+
     def get_lca(self, ListOfTaxid):
         """ given a list of taxid, return their lowest common ancestor
         :param ListOfTaxid:
@@ -289,6 +1652,11 @@ class TaxIds(object):
         """
         if len(ListOfTaxid) > 1:
             ListOfTaxid = [int(item) for item in ListOfTaxid]
+            # constant time per taxid if the LCA index was built
+            if self._lca_keys is not None:
+                lca = self._get_lca_by_index(ListOfTaxid)
+                if lca is not None:
+                    return lca
             return reduce(self._get_first_common_ancestor, ListOfTaxid)
 
         elif len(ListOfTaxid) == 1:
@@ -298,6 +1666,45 @@ class TaxIds(object):
             print "\n\n No Taxid was given in ListOfTaxid !!\n\n"
             sys.exit(0)
 
+    def get_subtree(self, taxids):
+        """ the subtree induced by taxids, i.e. the taxids and all their
+            ancestors up to root 1, found by following parent pointers once
+        :param taxids: list or numpy array of taxids
+        :return:       (nodes, parents) numpy arrays, root 1 is its own parent
+        """
+        taxids = self._resolve_batch(np.asarray(taxids, dtype=np.int64))
+        taxids = taxids[(taxids > 0) & (taxids < len(self._parent))]
+        marked = np.zeros(len(self._parent), dtype=bool)
+        frontier = np.unique(taxids)
+        while len(frontier):
+            marked[frontier] = True
+            frontier = np.unique(self._parent[frontier])
+            frontier = frontier[(frontier > 0) & ~marked[frontier]]
+        nodes = np.flatnonzero(marked)
+        parents = self._parent[nodes]
+        detached = nodes[((parents == nodes) & (nodes != 1)) | (parents == 0)]
+        assert not len(detached), "taxid %d is not under root 1"%detached[0]
+        return nodes, parents
+
+    def write_tree(self, oh, taxids, node_fmt="taxid", out_fmt="newick"):
+        """ write the subtree induced by taxids into a newick or phyloxml tree,
+            in one pass over the nodes and without building tree objects
+
+            node_fmt = taxid / sciName
+
+            out_fmt = newick / phyloxml
+        :param oh:     opened output file
+        :param taxids: list or numpy array of taxids
+        :return:       None
+        """
+        nodes, parents = self.get_subtree(taxids)
+        if node_fmt == "taxid":
+            labels = [str(taxid) for taxid in nodes.tolist()]
+        else:
+            assert node_fmt == "sciName", "The node_fmt should be taxid or sciName"
+            labels = [self.get_sciName(taxid) for taxid in nodes.tolist()]
+        _write_tree(oh, nodes, parents, labels, out_fmt)
+
     def path2newick(self, path2pathFile, node_fmt="taxid", out_fmt="newick"):
         """ This function take taxonomic path file as input, path should be consist
             of taxonomic id, not scitific name, because some scientific name are the
@@ -314,8 +1721,8 @@ class TaxIds(object):
 
         with open(path2pathFile, "r") as pathFile:
 
-            # read in pathFile, and store node info into nodes
-            nodes = {} # data format {"node_name": Clade_object}
+            # read in pathFile, and store the parent of each node
+            parent_of = {} # data format {taxid: parent_taxid}
             root = None
 
             # open file to parese line iterately
@@ -329,112 +1736,184 @@ class TaxIds(object):
                 else:
                     assert root == line[1], "The %d-th line is from a different root"%(i+1)
 
-                # check node iterately, first reverse list, to from leaf to root
-                # to make sure every node has a parent node
-                leaf2root = line[::-1]
-
-                for j, item in enumerate(leaf2root):
-                    # find child_node and parent_node, root node's parent is itself
-                    if j == len(line)-1:
-                        child_node = item; parent_node=item
-                    else:
-                        child_node = item; parent_node = leaf2root[j+1]
-
-                    if nodes.has_key(child_node):
-                        continue
-                    else:
-                        # add this node
-                        nodes[child_node] = Newick.Clade(name=child_node)
-                        # add its parent info
-                        nodes[child_node].parent = parent_node
-
-            for node_name, node_clade in nodes.iteritems():
-                # find the root node, its parent is itself
-                if node_name == node_clade.parent:
-                    root_node = node_clade
-                    print node_clade
-                    print "root node found!! "
-                # if node is not root, then find its parent, and add to its parent's clades
-                else:
-                    parent_node = nodes[node_clade.parent]
-                    parent_node.clades.append(node_clade)
-                del node_clade.parent
+                # root node's parent is itself
+                line = [int(item) for item in line]
+                parent_of.setdefault(line[0], line[0])
+                for parent, child in zip(line[:-1], line[1:]):
+                    parent_of.setdefault(child, parent)
 
-            # transform between output node format
-            if node_fmt=="taxid":
-                tree = Newick.Tree(root = root_node)
-            else:
-                assert node_fmt =="sciName", "The node_fmt should be taxid or sciName"
-                # convert taxid to sciName
-                for node_name, node in nodes.iteritems():
-                    node_name = self.get_sciName(node_name)
-                    for child in node.clades:
-                        if child:
-                            child.name = self.get_sciName(child.name)
-                root_node.name = self.get_sciName(root_node.name)
-                tree = Newick.Tree(root = root_node)
-
-            # write tree to file
-            print 'Writing %s tree to %s...' % (out_fmt, outFile)
-
-            bp.write(tree, outFile, out_fmt)
-
-    def taxid2tree(self, taxid_list, out_fmt="newick"):
-        """ This function take a list of gi as input, will generate a path for
-            for each gi, then construct a newick or phyloxml tree based on these
-            gi pathes.
+        nodes = np.array(sorted(parent_of), dtype=np.int64)
+        parents = np.array([parent_of[node] for node in nodes.tolist()], dtype=np.int64)
+
+        # transform between output node format
+        if node_fmt == "taxid":
+            labels = [str(node) for node in nodes.tolist()]
+        else:
+            assert node_fmt =="sciName", "The node_fmt should be taxid or sciName"
+            labels = [self.get_sciName(node) for node in nodes.tolist()]
+
+        # write tree to file
+        print 'Writing %s tree to %s...' % (out_fmt, outFile)
+
+        with open(outFile, "w") as oh:
+            _write_tree(oh, nodes, parents, labels, out_fmt)
+
+    def taxid2tree(self, taxid_list, out_fmt="newick", node_fmt="taxid"):
+        """ This function take a list of taxid as input, and construct a newick
+            or phyloxml tree of their pathes, see write_tree()
 
             out_fmt = newick / phyloxml ...
+
+            node_fmt = taxid / sciName
         """
         treeFile = StringIO()
+        self.write_tree(treeFile, taxid_list, node_fmt, out_fmt)
+        treeStr = treeFile.getvalue()
+        return treeStr
 
-        # get pathes for a list of taxid
-        path_list =[";".join([str(item) for item in self.get_path(taxid)])
-                    for taxid in taxid_list ]
 
-        # read in pathFile, and store node info into nodes
-        nodes = {} # data format {"node_name": Clade_object}
-        root = None
+def attach_shared_taxonomy(name):
+    """ attach to a taxonomy published by TaxIds.share(name), nothing is
+        parsed or copied, the arrays are read-only views of shared memory
+    :param name: name of shared memory segment
+    :return:     TaxIds instance
+    """
+    path = shared_snapshot_path(name)
+    if not os.path.exists(path):
+        raise IOError("No shared taxonomy was published as %s"%name)
+    return TaxIds(snapshot=path)
 
-        # to parese path iterately
-        for i, path in enumerate(path_list):
-            line = path.strip().split(";")
-            if root is None:
-                root = line[0]
-            else:
-                assert root == line[0], "The %d-th line is from a different root"%(i+1)
 
-            # check node iterately, first reverse list, to from leaf to root
-            # to make sure every node has a parent node
-            leaf2root = line[::-1]
+def unlink_shared_taxonomy(name):
+    """ remove a taxonomy published by TaxIds.share(name), attached
+        processes keep their mapping until they exit
+    :param name: name of shared memory segment
+    :return:     None
+    """
+    path = shared_snapshot_path(name)
+    if os.path.exists(path):
+        os.remove(path)
 
-            for j, item in enumerate(leaf2root):
-                # find child_node and parent_node, root node's parent is itself
-                if j == len(line)-1:
-                    child_node = item; parent_node=item
-                else:
-                    child_node = item; parent_node = leaf2root[j+1]
 
-                if nodes.has_key(child_node):
-                    continue
-                else:
-                    # add this node
-                    nodes[child_node] = Newick.Clade(name=child_node)
-                    # add its parent info
-                    nodes[child_node].parent = parent_node
-
-        for node_name, node_clade in nodes.iteritems():
-            # find the root node, its parent is itself
-            if node_name == node_clade.parent:
-                root_node = node_clade
-                print "root node is %s, constructing tree ..."%(str(node_name))
-            # if node is not root, then find its parent, and add to its parent's clades
+class _LazyNames(object):
+    """ scientific names looked up on demand in names.dmp, which NCBI sorts by
+        taxid, by binary search over byte offsets of its memory map, only the
+        pages searched are read, resolved names are cached
+    """
+
+    def __init__(self, names):
+        """
+        :param names: names.dmp file, sorted by taxid
+        """
+        self._fh = open(names, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._cache = {}
+        self._block = 1 << 14
+
+    def _line_taxid(self, start):
+        return int(self._mm[start:self._mm.find("\t", start)])
+
+    def get(self, taxid):
+        """ scientific name of taxid, None if it has none
+        """
+        if taxid in self._cache:
+            return self._cache[taxid]
+        mm = self._mm
+        # narrow down by binary search to a block holding the first line with
+        # taxid not smaller than the query, lo is always a line start
+        lo, hi = 0, len(mm)
+        while hi - lo > self._block:
+            mid = (lo + hi) // 2
+            start = mm.rfind("\n", 0, mid) + 1
+            if self._line_taxid(start) < taxid:
+                end = mm.find("\n", start)
+                lo = end + 1 if end >= 0 else len(mm)
             else:
-                parent_node = nodes[node_clade.parent]
-                parent_node.clades.append(node_clade)
-            del node_clade.parent
+                hi = start
+        # then find the line of taxid inside the block
+        key = "%d\t"%taxid
+        if mm[lo:lo+len(key)] != key:
+            # str.find() is much faster than mmap.find() of python 2
+            i = mm[lo:hi+len(key)+1].find("\n"+key)
+            lo = lo + i + 1 if i >= 0 else len(mm)
+        name = None
+        while lo < len(mm):
+            end = mm.find("\n", lo)
+            if end < 0:
+                end = len(mm)
+            line = mm[lo:end].rstrip("\t|").split("\t|\t")
+            if int(line[0]) != taxid:
+                break
+            # the last one wins, as in TaxIds._load_names()
+            if line[3] == "scientific name":
+                name = line[1]
+            lo = end + 1
+        self._cache[taxid] = name
+        return name
 
-        tree = Newick.Tree(root = root_node)
-        bp.write(tree, treeFile, out_fmt)
-        treeStr = treeFile.getvalue()
-        return treeStr
\ No newline at end of file
+    def close(self):
+        self._mm.close()
+        self._fh.close()
+
+
+class _NameKeys(object):
+    """ lower case names of a name index, as a sequence for bisect
+    """
+
+    def __init__(self, names, offset):
+        self._names = names
+        self._offset = offset
+
+    def __len__(self):
+        return len(self._offset) - 1
+
+    def __getitem__(self, i):
+        return self._names[self._offset[i]:self._offset[i+1]].lower()
+
+
+class _TaxIdContainer(object):
+    """ read-only {taxid: [scientificName, parent, rank]} view on the compact
+        arrays of a TaxIds instance, to keep code that used the old
+        TaxIds.container dict working
+    """
+
+    def __init__(self, taxids):
+        self._taxids = taxids
+
+    def __contains__(self, taxid):
+        taxid = _as_taxid(taxid)
+        return taxid is not None and self._taxids._has_taxid(taxid)
+
+    has_key = __contains__
+
+    def __getitem__(self, taxid):
+        if taxid not in self:
+            raise KeyError(taxid)
+        return [self._taxids.get_sciName(taxid),
+                self._taxids.get_parent(taxid),
+                self._taxids.get_rank(taxid)]
+
+    def get(self, taxid, default=None):
+        if taxid not in self:
+            return default
+        return self[taxid]
+
+    def _known(self):
+        _taxids = self._taxids
+        _taxids._require_names()
+        return np.flatnonzero((_taxids._parent != 0) |
+                              (np.diff(_taxids._name_offset) != 0))
+
+    def __iter__(self):
+        for taxid in self._known():
+            yield int(taxid)
+
+    def __len__(self):
+        return len(self._known())
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for taxid in self:
+            yield taxid, self[taxid]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+
+# <TaxonomyServer.py, serve NCBI taxonomy queries over a Unix domain socket>
+# Copyright (C) <2016>  <Shengwei Hou> <housw2010'at'gmail'dot'com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import socket
+import tempfile
+import threading
+import Queue
+import SocketServer
+import numpy as np
+
+
+# socket used when none is given
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "vahine_taxonomy.sock")
+
+# TaxIds methods served, each request carries a list of query items, one
+# taxid for most methods, one list of taxids for get_lca, one name for get_taxids
+SERVED_METHODS = ["get_parent", "get_sciName", "get_rank", "get_path", "get_lca", "get_lineage",
+                  "get_taxids"]
+
+
+# methods answered for all items of a request at once by the batch methods of
+# TaxIds, with the keyword arguments they take
+BATCH_METHODS = {"get_sciName": [], "get_rank": [], "get_path": ["toStr"], "get_lineage": ["toStr"]}
+
+
+# json values kept by _to_str()
+_NUMBER_TYPES = frozenset([int, long, float, bool, type(None)])
+
+
+def _to_str(obj):
+    """ json gives unicode strings, convert them back to str as TaxIds returns
+    """
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    if isinstance(obj, list):
+        # lists of numbers, e.g. paths of taxids, are left as they are
+        if not _NUMBER_TYPES.issuperset(map(type, obj)):
+            return [_to_str(item) for item in obj]
+    return obj
+
+
+class TaxonomyRequestHandler(SocketServer.StreamRequestHandler):
+    """ one json request per line:
+
+        {"method": "get_path", "items": [taxid, ...], "kwargs": {"toStr": true}}
+
+        one json response per line, in the order of requests, so a client may
+        send many requests before reading any response:
+
+        {"result": [result of item, ...]} or {"error": "message"}
+    """
+
+    def handle(self):
+        # responses are written by another thread, so requests keep being read
+        # while a pipelining client is still sending and not yet receiving
+        responses = Queue.Queue()
+        writer = threading.Thread(target=self._write_responses, args=(responses,))
+        writer.daemon = True
+        writer.start()
+
+        # readline, file iteration reads ahead and would wait for more requests
+        for line in iter(self.rfile.readline, ""):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = {"result": self.server.query(str(request["method"]), request["items"],
+                                                        request.get("kwargs") or {})}
+            except Exception as e:
+                response = {"error": "%s: %s"%(type(e).__name__, e)}
+            responses.put(json.dumps(response)+"\n")
+        responses.put(None)
+        writer.join()
+
+    def _write_responses(self, responses):
+        for response in iter(responses.get, None):
+            try:
+                self.wfile.write(response)
+                self.wfile.flush()
+            except socket.error:
+                # client is gone, the reader stops at end of its requests
+                return
+
+
+class TaxonomyServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ serve queries of a loaded TaxIds instance over a Unix domain socket,
+        the taxonomy is loaded once and shared by all clients
+    """
+    daemon_threads = True
+
+    def __init__(self, taxids, socket_path=DEFAULT_SOCKET):
+        """
+        :param taxids:      loaded TaxIds instance
+        :param socket_path: Unix domain socket to listen on, an existing
+                            socket file is replaced
+        """
+        self.taxids = taxids
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, TaxonomyRequestHandler)
+
+    def query(self, method, items, kwargs):
+        """ answer one batch request
+        :param method: one of SERVED_METHODS
+        :param items:  list of query items
+        :param kwargs: keyword arguments of method
+        :return:       list of results, one per item
+        """
+        if method not in SERVED_METHODS:
+            raise ValueError("unknown method %s"%method)
+        items = _to_str(items)
+        kwargs = dict((str(key), value) for key, value in kwargs.iteritems())
+
+        # all groups of taxids in one vectorized call
+        if method == "get_lca":
+            taxids = [int(taxid) for group in items for taxid in group]
+            offsets = np.cumsum([0] + [len(group) for group in items])
+            lca, _, _ = self.taxids.get_lca_batch(np.array(taxids, dtype=np.int64), offsets)
+            return lca.tolist()
+
+        # integer taxids in one vectorized call, other items such as taxids
+        # in strings are converted one by one by TaxIds
+        if method in BATCH_METHODS and set(kwargs) <= set(BATCH_METHODS[method]):
+            taxids = np.array(items)
+            if len(taxids) and taxids.dtype.kind in "iu":
+                return self._query_batch(method, taxids, kwargs.get("toStr", False))
+
+        func = getattr(self.taxids, method)
+        return [func(item, **kwargs) for item in items]
+
+    def _query_batch(self, method, taxids, toStr):
+        """ answer a request of BATCH_METHODS for a numpy array of taxids
+        """
+        if method == "get_sciName":
+            return self.taxids.get_sciName_batch(taxids).tolist()
+        if method == "get_rank":
+            return self.taxids.get_rank_batch(taxids).tolist()
+
+        if method == "get_lineage":
+            lineage = self.taxids.get_lineage_batch(taxids)
+            if toStr:
+                return self.taxids.get_sciName_batch(lineage.ravel()).reshape(lineage.shape).tolist()
+            ret = lineage.astype(object)
+            ret[lineage == 0] = None
+            return ret.tolist()
+
+        paths = self.taxids.get_path_batch(taxids)
+        if not toStr:
+            return paths
+        # names of all taxids on the paths, each looked up once
+        on_path = np.unique([taxid for path in paths if path for taxid in path])
+        names = dict(zip(on_path.tolist(), self.taxids.get_sciName_batch(on_path).tolist()))
+        return [";".join([names[taxid] for taxid in path])+";" if path else None for path in paths]
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class TaxIdsClient(object):
+    """ query a TaxonomyServer, single queries have the same interface as
+        TaxIds, request() sends thousands of items in one round trip, and
+        send()/receive() pipeline many requests on one connection
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._rfile = self._socket.makefile("rb")
+        self._wfile = self._socket.makefile("wb")
+        self._pending = 0
+
+    def send(self, method, items, **kwargs):
+        """ send one request without waiting for its response
+        :param method: one of SERVED_METHODS
+        :param items:  list of query items
+        :return:       None
+        """
+        items = items.tolist() if hasattr(items, "tolist") else list(items)
+        self._wfile.write(json.dumps({"method": method, "items": items, "kwargs": kwargs})+"\n")
+        self._pending += 1
+
+    def receive(self):
+        """ wait for the response of the earliest request not received yet
+        :return: list of results, one per item
+        """
+        if not self._pending:
+            raise ValueError("No request is waiting for response")
+        self._wfile.flush()
+        line = self._rfile.readline()
+        if not line:
+            raise IOError("Taxonomy server at %s closed the connection"%self.socket_path)
+        self._pending -= 1
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return _to_str(response["result"])
+
+    def request(self, method, items, **kwargs):
+        """ send one request and wait for its response
+        """
+        self.send(method, items, **kwargs)
+        return self.receive()
+
+    def get_parent(self, taxid):
+        return self.request("get_parent", [taxid])[0]
+
+    def get_sciName(self, taxid):
+        return self.request("get_sciName", [taxid])[0]
+
+    def get_rank(self, taxid):
+        return self.request("get_rank", [taxid])[0]
+
+    def get_path(self, taxid, toStr=False):
+        return self.request("get_path", [taxid], toStr=toStr)[0]
+
+    def get_lca(self, ListOfTaxid):
+        return self.request("get_lca", [[int(taxid) for taxid in ListOfTaxid]])[0]
+
+    def get_lineage(self, taxid, toStr=False):
+        return self.request("get_lineage", [taxid], toStr=toStr)[0]
+
+    def get_taxids(self, name, ignore_case=False, prefix=False, synonyms=True):
+        return self.request("get_taxids", [name], ignore_case=ignore_case, prefix=prefix,
+                            synonyms=synonyms)[0]
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._socket.close()